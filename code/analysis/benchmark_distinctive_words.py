@@ -0,0 +1,210 @@
+## Some simple benchmarks of distinctive_words.py
+##
+## The stages benchmark measures documents/sec through each stage of parsing
+## the documents, using a sample of those in the database. The sketches 
+## benchmark compares the approximate token counts (sketches) to the exact 
+## counts, in memory, time and accuracy, using the documents that 
+## distinctive_words.py has saved to its token cache. They can be run with:
+## `python benchmark_distinctive_words.py --benchmarks stages sketches`
+
+import distinctive_words as dw
+import toolz.curried as tz   # functional programming library
+import numpy as np           # for the sketches
+import sqlalchemy as sqlal   # for reading the sample documents
+from bs4 import BeautifulSoup # for the html stripping the parsing used to do
+import re                    # regular expressions
+import sqlite3               # for reading the token cache
+import argparse              # for accepting command line arguments
+import datetime as dt        # for building the time steps
+import time                  # for timing the benchmarks
+import sys                   # for measuring memory use
+
+## Accept Arguments
+parser = argparse.ArgumentParser(description="Benchmark the parsing and token counting of distinctive_words.py")
+parser.add_argument('--benchmarks', type=str, nargs='+', default=['stages', 'sketches'],
+                    choices=['stages', 'sketches'], help='Which benchmarks to run')
+parser.add_argument('--database', type=str, default="../../data/demdebate/demdebate.sqlite",
+                    help='The SQLite database with the stream tables')
+parser.add_argument('--stream_names', type=str, nargs='+',
+                    default=['comments_debate', 'posts_debate', 'tweets_debate'],
+                    help='The streams to sample documents from')
+parser.add_argument('--num_documents', type=int, default=2000,
+                    help='The number of documents to sample from each stream')
+parser.add_argument('--token_cache', type=str, default="../../data/demdebate/token_cache.sqlite",
+                    help='The token cache saved by distinctive_words.py')
+parser.add_argument('--time_step', type=int, default=30,
+                    help='Minutes in each time step')
+parser.add_argument('--epsilon', type=float, nargs='+', default=[0.001, 0.0001],
+                    help='The error bounds to try (as a fraction of the tokens in a sketch)')
+parser.add_argument('--delta', type=float, default=0.001,
+                    help='The chance of an estimate being outside the error bound')
+parser.add_argument('--num_heavy_hitters', type=int, default=2000,
+                    help='The number of most frequent tokens each sketch keeps')
+
+## Main Functions
+def main():
+    """Run each of the benchmarks and print the results"""
+    args = parser.parse_args()
+    if 'stages' in args.benchmarks:
+        db_engine = sqlal.create_engine('sqlite:///{}'.format(args.database))
+        for stream_name in args.stream_names:
+            benchmark_stages(stream_name, tz.pipe(
+                dw.get_content(db_engine, stream_name, ["0", "9"]), # any time
+                tz.take(args.num_documents),
+                tz.map(lambda x: x[2] or ''), # only the content
+                list))
+    if 'sketches' in args.benchmarks:
+        benchmark_all_sketches(args)
+
+def benchmark_all_sketches(args):
+    """Run the sketches benchmark for each of the error bounds"""
+    cache = sqlite3.connect(args.token_cache)
+    try:
+        settings, stream_names, date_ranges = describe_cache(cache, args.time_step)
+        print("Comparing {} streams over {} time steps of {} minutes".format(
+            len(stream_names), len(date_ranges), args.time_step))
+        for epsilon in args.epsilon:
+            benchmark_sketches(cache, settings, stream_names, date_ranges, {
+                'epsilon': epsilon,
+                'delta': args.delta,
+                'num_heavy_hitters': args.num_heavy_hitters})
+    finally:
+        cache.close()
+
+def benchmark_stages(stream_name, documents):
+    """Measure documents/sec through each stage of parsing the documents,
+    comparing the earlier versions of the stages where they changed"""
+    def original_chunk_string(size, given_iterator):
+        """chunk_string, as it was before joining the strings"""
+        storage = ''
+        for num, x in enumerate(given_iterator):
+            storage = storage + x
+            if num % size == 0:
+                yield storage
+                storage = ''
+        yield storage
+    print("Parsing {} documents from {}".format(len(documents), stream_name))
+    text = map(dw.strip_html, documents)
+    print_rate("strip html, BeautifulSoup", measure_rate(
+        lambda x: [BeautifulSoup(y, 'html.parser').get_text() for y in x], documents))
+    print_rate("strip html", measure_rate(lambda x: map(dw.strip_html, x), documents))
+    print_rate("detect language", measure_rate(
+        lambda x: map(dw.detect_language, x), text, repeat=1))
+    print_rate("remove urls, uncompiled", measure_rate(
+        lambda x: [re.sub(r'http.*?(?=\s)', "", y) for y in x], text))
+    print_rate("remove urls", measure_rate(lambda x: [dw.URL_PATTERN.sub("", y) for y in x], text))
+    print_rate("chunk, concatenating", measure_rate(
+        lambda x: list(original_chunk_string(500, x)), text))
+    print_rate("chunk", measure_rate(lambda x: list(dw.chunk_string(500, x)), text))
+    chunks = list(dw.chunk_string(500, text))
+    print_rate("tag parts of speech", measure_rate(
+        lambda x: map(dw.tag_parts_of_speech, chunks), text, repeat=1))
+    tokens = [x[0].lower() for x in tz.concat(map(dw.tag_parts_of_speech, chunks))]
+    lemmatizer = dw.load_nlp_models()['lemmatizer']
+    print("    ({} tokens, {:.1f} per document)".format(
+        len(tokens), len(tokens) / float(max(len(documents), 1))))
+    print_rate("lemmatize", measure_rate(
+        lambda x: map(lemmatizer.lemmatize, tokens), text, repeat=1))
+
+def benchmark_sketches(cache, settings, stream_names, date_ranges, sketch_settings):
+    """Compare the sketches with the given settings to the exact counts,
+    for each stream and time step"""
+    max_num_words = 30 # as in distinctive_words.main
+    results = []
+    for date_range in date_ranges:
+        exact_counts, exact_time = measure_time(lambda: [
+            dw.get_cached_count(cache, settings, x, date_range) for x in stream_names])
+        sketches, sketch_time = measure_time(lambda: [
+            dw.get_cached_sketch(sketch_settings, cache, settings, x, date_range) for x in stream_names])
+        exact_words = dw.compare_streams(
+            lambda stream_name, _: exact_counts[stream_names.index(stream_name)],
+            date_range, stream_names, max_num_words)
+        sketch_words = dw.compare_streams(
+            lambda stream_name, _: sketches[stream_names.index(stream_name)],
+            date_range, stream_names, max_num_words, dw.build_sketch_matrix)
+        results.append({
+            'exact_bytes': sum(map(measure_dict_bytes, exact_counts)),
+            'sketch_bytes': sum(map(measure_sketch_bytes, sketches)),
+            'exact_time': exact_time,
+            'sketch_time': sketch_time,
+            'top_tokens_found': [
+                measure_overlap(
+                    tz.pluck(0, dw.get_top_tokens(500, counts)), sketch['heavy_hitters'])
+                for counts, sketch in zip(exact_counts, sketches)],
+            'distinct_words_found': [
+                measure_overlap(
+                    tz.pluck('token', exact_words[x]), tz.pluck('token', sketch_words[x]))
+                for x in stream_names],
+        })
+    print("epsilon={epsilon}, delta={delta}, num_heavy_hitters={num_heavy_hitters}".format(**sketch_settings))
+    print("    {:<40} {:>12,.0f} {:>12,.0f}".format(
+        "largest time step, bytes (exact, sketch)",
+        max(x['exact_bytes'] for x in results),
+        max(x['sketch_bytes'] for x in results)))
+    print("    {:<40} {:>12.2f} {:>12.2f}".format(
+        "counting, seconds (exact, sketch)",
+        sum(x['exact_time'] for x in results),
+        sum(x['sketch_time'] for x in results)))
+    print("    {:<40} {:>12.1%}".format(
+        "top 500 tokens kept by the sketches",
+        np.mean(list(tz.concat(x['top_tokens_found'] for x in results)))))
+    print("    {:<40} {:>12.1%}".format(
+        "distinct words that match",
+        np.mean(list(tz.concat(x['distinct_words_found'] for x in results)))))
+
+## Helper Functions
+def describe_cache(cache, time_step):
+    """Return the parse settings with the most cached documents, the streams
+    and the time steps covering those documents"""
+    settings = cache.execute(
+        "SELECT settings FROM documents GROUP BY settings ORDER BY count(*) DESC LIMIT 1").fetchone()[0]
+    stream_names = [x[0] for x in cache.execute(
+        "SELECT DISTINCT stream FROM documents WHERE settings = ? ORDER BY stream", (settings,))]
+    first, last = [
+        dt.datetime.strptime(x[:16], "%Y-%m-%dT%H:%M") # to the minute
+        for x in cache.execute(
+            "SELECT min(timestamp), max(timestamp) FROM documents WHERE settings = ?",
+            (settings,)).fetchone()]
+    num_steps = int((last - first).total_seconds() // (time_step * 60)) + 1
+    date_ranges = [
+        [(first + dt.timedelta(minutes=time_step * x)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+         (first + dt.timedelta(minutes=time_step * (x + 1))).strftime("%Y-%m-%dT%H:%M:%SZ")]
+        for x in range(num_steps)]
+    return settings, stream_names, date_ranges
+
+def measure_time(func):
+    """Return the result of func() and the seconds it took"""
+    start_time = time.time()
+    result = func()
+    return result, time.time() - start_time
+
+def measure_rate(func, items, repeat=3):
+    """Return the best items/second from repeat runs of func over items"""
+    best_time = None
+    for _ in range(repeat):
+        _, duration = measure_time(lambda: func(items))
+        best_time = duration if best_time is None else min(best_time, duration)
+    return len(items) / max(best_time, 1e-9)
+
+def print_rate(label, rate):
+    """Print a line of benchmark results"""
+    print("    {:<40} {:>12,.0f} documents per second".format(label, rate))
+
+def measure_dict_bytes(given_dict):
+    """Return roughly how many bytes the dictionary and its contents use"""
+    return sys.getsizeof(given_dict) + sum(
+        sys.getsizeof(key) + sys.getsizeof(value) for key, value in given_dict.items())
+
+def measure_sketch_bytes(sketch):
+    """Return roughly how many bytes the sketch uses"""
+    return sketch['table'].nbytes + measure_dict_bytes(sketch['heavy_hitters'])
+
+def measure_overlap(expected, found):
+    """Return the fraction of the expected items that were found"""
+    expected = set(expected)
+    if len(expected) == 0:
+        return 1.0
+    return len(expected & set(found)) / float(len(expected))
+
+if __name__ == '__main__':
+    main()
@@ -8,18 +8,27 @@
 # differs between these streams. 
 # 
 import sqlalchemy as sqlal                     # for connecting to databases
-import pandas as pd                            # for data wrangling
+import sqlite3                                 # for the cache of token counts
+import numpy as np                             # for scoring the tokens of every stream at once
 import toolz.curried as tz                     # functional programming library
-from bs4 import BeautifulSoup                  # for handling html
+import HTMLParser                              # for unescaping html entities
 import nltk                                    # for natural language parsing
 from textblob import TextBlob                  # for part of speech tagging
 from textblob_aptagger import PerceptronTagger # for part of speech tagging
 import langdetect                              # For estimating the language of some text
 import re                                      # regular expressions
+import collections                             # for the memos of NLP results
+import multiprocessing                         # for tokenizing on several cores
+import functools                               # for passing arguments to workers
+import hashlib                                 # for noticing changed documents
+import json                                    # for describing the parse settings
+import math                                    # for sizing the sketches
+import struct                                  # for turning hashes into numbers
 import datetime as dt                          # for handling stream timestamps
 import time                                    # for simple benchmarking
 import jinja2                                  # for generating html
 import pdb                                     # for debugging
+from load_to_db import quote_name              # shared with the loader
 
 ## Decorators
 def timed(func):
@@ -54,13 +63,27 @@ def main():
         'max_num_words': 30, # number of words to return for a given time step
         # Which parts of speech to include (also accepts the string 'all')
         'allowed_parts_of_speech': verb_tags + adjective_tags + noun_tags, 
+        # Number of processes to parse the content with (1 runs it serially)
+        'num_workers': multiprocessing.cpu_count(),
+        # Where to keep the token counts of each document, so they are only 
+        # parsed once (for any time_step or date range). None parses the 
+        # documents of each time step directly, without a cache.
+        'token_cache': '../../data/demdebate/token_cache.sqlite',
+        # To count the tokens approximately, in a fixed amount of memory, give
+        # the settings of the sketches (see new_sketch). For example:
+        # {'epsilon': 0.0001, 'delta': 0.001, 'num_heavy_hitters': 2000}
+        'approximate_counts': None,
     }
     distinct_words = compare_streams_across_time(db_engine, configuration)
     save_as_html(distinct_words, "distinct_words_display/test.html")
 
 def compare_streams_across_time(db_engine, configuration):
     """Return distinct words for each considered stream at each time step in 
-    the given date range."""
+    the given date range.
+
+    If there is a token cache, the documents are parsed into it first, and 
+    each time step is then counted from the cache. With approximate_counts,
+    each stream's tokens are counted into a sketch rather than a dictionary."""
     def date_range_iterator(overall_date_range, time_step):
         """Returns an iterator of the time ranges being considered.
         time_step is assumed to be in minutes"""
@@ -80,45 +103,81 @@ def compare_streams_across_time(db_engine, configuration):
             tz.map(lambda x: [
                 get_time(overall_start, time_step, x-1), 
                 get_time(overall_start, time_step, x)]))
-    result = []
-    for date_range in date_range_iterator(configuration['overall_date_range'], configuration['time_step']):
-        result.append(
-            tz.pipe( # Stream comparison for a particular time period
-                compare_streams(
-                    db_engine,
-                    date_range,
-                    configuration['stream_names'],
-                    configuration['allowed_parts_of_speech'],
-                    configuration['max_num_words']),
-                lambda x: tz.merge(x, {'date_range': date_range}))) # add in date_range entry
+    date_ranges = list(date_range_iterator(configuration['overall_date_range'], configuration['time_step']))
+    scanned_date_range = [date_ranges[0][0], date_ranges[-1][1]] # all of the time steps
+    allowed_parts_of_speech = configuration['allowed_parts_of_speech']
+    sketch_settings = configuration.get('approximate_counts')
+    MEMO_STATS.clear() # to report on this run
+    pool = None # parse serially
+    if configuration.get('num_workers', 1) > 1:
+        pool = multiprocessing.Pool(configuration['num_workers'], initializer=load_nlp_models)
+    cache = None
+    try:
+        if configuration.get('token_cache') is None:
+            if sketch_settings is None:
+                parse_function = parse_content_into_count(allowed_parts_of_speech, pool)
+            else:
+                parse_function = parse_content_into_sketch(sketch_settings, allowed_parts_of_speech, pool)
+            content_in_window = read_in_windows(db_engine, scanned_date_range)
+            count_function = lambda stream_name, date_range: tz.pipe(
+                content_in_window(stream_name, date_range),
+                parse_function)
+        else:
+            cache = sqlite3.connect(configuration['token_cache'])
+            settings = get_settings_key(allowed_parts_of_speech)
+            update_token_cache(
+                db_engine,
+                cache,
+                settings,
+                configuration['stream_names'],
+                scanned_date_range,
+                allowed_parts_of_speech,
+                pool)
+            if sketch_settings is None:
+                count_function = functools.partial(get_cached_count, cache, settings)
+            else:
+                count_function = functools.partial(get_cached_sketch, sketch_settings, cache, settings)
+        build_matrix = build_count_matrix if sketch_settings is None else build_sketch_matrix
+        result = []
+        for date_range in date_ranges:
+            result.append(
+                tz.pipe( # Stream comparison for a particular time period
+                    compare_streams(
+                        count_function,
+                        date_range,
+                        configuration['stream_names'],
+                        configuration['max_num_words'],
+                        build_matrix),
+                    lambda x: tz.merge(x, {'date_range': date_range}))) # add in date_range entry
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if cache is not None:
+            cache.close()
+    report_memo_stats()
     return result
 
-def compare_streams(db_engine, date_range, stream_names, allowed_parts_of_speech, max_num_words):
-    """Compare tokens from each stream in the stream_names list"""
+def compare_streams(count_function, date_range, stream_names, max_num_words, build_matrix=None):
+    """Compare tokens from each stream in the stream_names list, counting 
+    them with count_function(stream_name, date_range) and combining the 
+    counts with build_matrix (build_count_matrix by default)"""
+    build_matrix = build_matrix or build_count_matrix
 
-    ## Create token count dictionaries for each stream name
-    count_dicts_dict = {}
-    for stream_name in stream_names:
-        count_dicts_dict[stream_name] = tz.pipe(
-            get_content(
-                db_engine, 
-                stream_name,
-                date_range),
-            parse_content_into_count(max_num_words, allowed_parts_of_speech))
-
-    ## Create cross-stream count dictionary
-    all_streams_count_dict = reduce(
-        lambda x,y: tz.merge_with(sum, x, y),
-        count_dicts_dict.values())
+    ## Create a (stream x token) count matrix
+    vocabulary, count_matrix, stream_totals = build_matrix([
+        count_function(stream_name, date_range)
+        for stream_name in stream_names])
 
     ## Calculate posterior probabilities of the tokens
     posterior_probs = {}
-    for stream_name in stream_names:
+    for stream_num, stream_name in enumerate(stream_names):
         posterior_probs[stream_name] = tz.pipe(
-            get_posterior_probs_freq(
+            get_posterior_probs_matrix(
                 500, # limited to the 500 most frequent words in this stream, at this time
-                all_streams_count_dict, 
-                count_dicts_dict[stream_name]),
+                vocabulary,
+                count_matrix,
+                stream_totals,
+                stream_num),
             tz.map(lambda x: tz.merge({"stream":stream_name}, x)),
             tz.take(max_num_words),
             list,
@@ -177,90 +236,505 @@ def save_as_html(distinct_words, file_name):
             lambda x: x.encode('utf8'),
             lambda x: f.write(x))
 
+## Token Cache Functions
+TOKENIZER_VERSION = 2 # increase when the parsing changes, to re-parse the cached documents
+
+@timed
+def update_token_cache(db_engine, cache, settings, stream_names, date_range, allowed_parts_of_speech, pool=None):
+    """Parse each document in the date range that isn't in the cache yet 
+    (or has changed since it was cached) and save its token counts
+
+    A document whose content is unchanged but whose timestamp has changed 
+    just has its timestamp updated. Cached documents in the date range that
+    are no longer in the stream's table (such as after the table was made 
+    again) are removed."""
+    create_token_cache(cache)
+    for stream_name in stream_names:
+        cached = { # row_id -> (timestamp, content_hash)
+            x[0]: (x[1], x[2]) for x in cache.execute(
+                "SELECT row_id, timestamp, content_hash FROM documents WHERE settings = ? AND stream = ?",
+                (settings, stream_name))}
+        seen_row_ids = set()
+        num_parsed = 0
+        for documents in tz.pipe(
+                get_content(db_engine, stream_name, date_range),
+                tz.map(lambda x: x + (hash_content(x[2]),)), # (row_id, timestamp, content, hash)
+                tz.map(tz.do(lambda x: seen_row_ids.add(x[0]))),
+                tz.filter(lambda x: cached.get(x[0]) != (x[1], x[3])),
+                tz.partition_all(READ_CHUNK_SIZE)):
+            is_new = lambda x: cached.get(x[0], (None, None))[1] != x[3] # not just moved
+            new_documents = [x for x in documents if is_new(x)]
+            token_counts = parse_content_into_counts(
+                allowed_parts_of_speech, pool, [x[2] for x in new_documents])
+            save_token_counts(cache, settings, stream_name, new_documents, token_counts)
+            move_cached_documents(
+                cache, settings, stream_name, [x for x in documents if not is_new(x)])
+            num_parsed += len(new_documents)
+        removed_row_ids = [
+            row_id for row_id, (timestamp, _) in cached.items()
+            if row_id not in seen_row_ids and date_range[0] <= timestamp < date_range[1]]
+        remove_cached_documents(cache, settings, stream_name, removed_row_ids)
+        print("{}: parsed {} new documents, {} already cached, {} removed".format(
+            stream_name, num_parsed, len(seen_row_ids) - num_parsed, len(removed_row_ids)))
+
+def create_token_cache(cache):
+    """Create the token cache's tables, if they don't exist yet"""
+    cache.execute("""
+        CREATE TABLE IF NOT EXISTS documents (
+            settings TEXT, stream TEXT, row_id INTEGER, timestamp TEXT, content_hash TEXT,
+            PRIMARY KEY (settings, stream, row_id))""")
+    cache.execute("""
+        CREATE TABLE IF NOT EXISTS token_counts (
+            settings TEXT, stream TEXT, row_id INTEGER, timestamp TEXT, token TEXT, count INTEGER)""")
+    cache.execute("""
+        CREATE INDEX IF NOT EXISTS token_counts_by_time 
+        ON token_counts (settings, stream, timestamp)""")
+    cache.execute("""
+        CREATE INDEX IF NOT EXISTS token_counts_by_row
+        ON token_counts (settings, stream, row_id)""")
+    cache.commit()
+
+def save_token_counts(cache, settings, stream_name, documents, token_counts):
+    """Replace the cached token counts of the given documents"""
+    with cache: # in one transaction
+        for (row_id, timestamp, _, content_hash), counts in zip(documents, token_counts):
+            cache.execute(
+                "DELETE FROM token_counts WHERE settings = ? AND stream = ? AND row_id = ?",
+                (settings, stream_name, row_id))
+            cache.execute(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?)",
+                (settings, stream_name, row_id, timestamp, content_hash))
+            cache.executemany(
+                "INSERT INTO token_counts VALUES (?, ?, ?, ?, ?, ?)",
+                [(settings, stream_name, row_id, timestamp, token, count)
+                 for token, count in (counts or {}).items()])
+
+def move_cached_documents(cache, settings, stream_name, documents):
+    """Update the timestamps of the given cached documents"""
+    with cache: # in one transaction
+        for row_id, timestamp, _, _ in documents:
+            for table in ['documents', 'token_counts']:
+                cache.execute(
+                    "UPDATE {} SET timestamp = ? WHERE settings = ? AND stream = ? AND row_id = ?".format(table),
+                    (timestamp, settings, stream_name, row_id))
+
+def remove_cached_documents(cache, settings, stream_name, row_ids):
+    """Remove the given documents, and their token counts, from the cache"""
+    with cache: # in one transaction
+        for table in ['documents', 'token_counts']:
+            cache.executemany(
+                "DELETE FROM {} WHERE settings = ? AND stream = ? AND row_id = ?".format(table),
+                [(settings, stream_name, row_id) for row_id in row_ids])
+
+def get_cached_count(cache, settings, stream_name, date_range):
+    """Return a dictionary of tokens (as keys) and counts (as values) for
+    the cached documents from the stream in the given date range"""
+    return dict(cache.execute("""
+        SELECT token, sum(count)
+        FROM token_counts
+        WHERE settings = ? AND stream = ? AND timestamp >= ? AND timestamp < ?
+        GROUP BY token""",
+        (settings, stream_name, date_range[0], date_range[1])))
+
+def get_cached_sketch(sketch_settings, cache, settings, stream_name, date_range):
+    """Return a sketch of the token counts of the cached documents from the 
+    stream in the given date range, without counting every token exactly"""
+    rows = cache.execute("""
+        SELECT token, count
+        FROM token_counts
+        WHERE settings = ? AND stream = ? AND timestamp >= ? AND timestamp < ?""",
+        (settings, stream_name, date_range[0], date_range[1]))
+    return tz.pipe(
+        iter(lambda: rows.fetchmany(10000), []),
+        tz.map(lambda x: tz.reduceby(0, lambda total, y: total + y[1], x, 0)), # counts in each batch
+        lambda x: reduce(add_to_sketch, x, new_sketch(**sketch_settings)))
+
+def get_settings_key(allowed_parts_of_speech):
+    """Return a key for the settings that change how documents are parsed"""
+    if allowed_parts_of_speech != "all":
+        allowed_parts_of_speech = sorted(allowed_parts_of_speech)
+    return tz.pipe(
+        {'allowed_parts_of_speech': allowed_parts_of_speech, 'version': TOKENIZER_VERSION},
+        lambda x: json.dumps(x, sort_keys=True),
+        lambda x: hashlib.sha1(x).hexdigest()[:16])
+
+def hash_content(content):
+    """Return a hash of a document's content"""
+    if isinstance(content, unicode):
+        content = content.encode('utf8')
+    elif not isinstance(content, str):
+        content = '' # missing content
+    return hashlib.sha1(content).hexdigest()
+
+## NLP Context Functions
+MEMO_SIZE = 20000 # the most results each memo keeps (the least recently used are dropped)
+NLP_CONTEXT = {} # the models and memos of this process, see load_nlp_models
+MEMO_STATS = {} # (memo, 'hits' or 'misses') totals, collected from every process
+POOL_BATCH_SIZE = 400 # items given to the pool of worker processes at a time
+
+def load_nlp_models():
+    """Return the NLP context of this process, loading the part of speech 
+    tagger and lemmatizer the first time this is called in each process
+
+    The context also has a memo for detecting the language of a document and
+    for lemmatizing a token, since the same text often comes up again (such 
+    as retweets and reblogged posts). Both keep small results, so the memos
+    stay a few megabytes in each process."""
+    if len(NLP_CONTEXT) == 0:
+        NLP_CONTEXT['tagger'] = PerceptronTagger()
+        NLP_CONTEXT['lemmatizer'] = nltk.stem.WordNetLemmatizer()
+        NLP_CONTEXT['memos'] = collections.defaultdict(collections.OrderedDict)
+        NLP_CONTEXT['memo_stats'] = collections.Counter() # since the last pop_memo_stats
+    return NLP_CONTEXT
+
+def memoized(memo_name, key, func, *args):
+    """Return func(*args), from the named memo if it has been found for the
+    key already"""
+    context = load_nlp_models()
+    memo = context['memos'][memo_name]
+    if key in memo:
+        context['memo_stats'][(memo_name, 'hits')] += 1
+        value = memo.pop(key) # move it to the most recently used end
+    else:
+        context['memo_stats'][(memo_name, 'misses')] += 1
+        value = func(*args)
+        if len(memo) >= MEMO_SIZE:
+            memo.popitem(last=False) # drop the least recently used
+    memo[key] = value
+    return value
+
+def pop_memo_stats():
+    """Return the memo hits and misses in this process since this was 
+    last called"""
+    memo_stats = load_nlp_models()['memo_stats']
+    result = dict(memo_stats)
+    memo_stats.clear()
+    return result
+
+def with_memo_stats(func, given_item):
+    """Return func(given_item) along with the memo stats since the last 
+    call, so they can be collected from worker processes"""
+    result = func(given_item)
+    return result, pop_memo_stats()
+
+def collect_memo_stats(result_and_stats):
+    """Add the memo stats to the totals in MEMO_STATS and return the result"""
+    result, memo_stats = result_and_stats
+    for key, value in memo_stats.items():
+        MEMO_STATS[key] = MEMO_STATS.get(key, 0) + value
+    return result
+
+@tz.curry
+def map_with_pool(pool, func, items):
+    """Map func over the items, across the pool's worker processes (or 
+    serially if pool is None), collecting the memo stats from each"""
+    if pool is None:
+        results = tz.map(functools.partial(with_memo_stats, func), items)
+    else:
+        # Given to the pool in batches, as it would otherwise read all of the
+        # items into memory at once
+        results = tz.concat(
+            pool.imap(functools.partial(with_memo_stats, func), batch, chunksize=20)
+            for batch in tz.partition_all(POOL_BATCH_SIZE, items))
+    return tz.map(collect_memo_stats, results)
+
+def report_memo_stats():
+    """Print the hit rate of each memo"""
+    for memo_name in sorted(set(x[0] for x in MEMO_STATS)):
+        hits = MEMO_STATS.get((memo_name, 'hits'), 0)
+        misses = MEMO_STATS.get((memo_name, 'misses'), 0)
+        print("The {} memo had {} hits and {} misses ({:.1%} hit rate)".format(
+            memo_name, hits, misses, float(hits) / max(hits + misses, 1)))
+
+## Sketch Functions
+def new_sketch(epsilon, delta, num_heavy_hitters):
+    """Return an empty sketch of token counts
+
+    It has a Count-Min Sketch, whose estimates are (with probability at least
+    1 - delta) at most epsilon times the total number of tokens too high, and 
+    a Space-Saving summary of the num_heavy_hitters most frequent tokens."""
+    return {
+        'table': np.zeros(
+            (int(math.ceil(math.log(1.0 / delta))), int(math.ceil(math.e / epsilon))),
+            dtype=np.int64),
+        'total': 0, # tokens added
+        'heavy_hitters': {}, # token: count (an overestimate)
+        'num_heavy_hitters': num_heavy_hitters,
+    }
+
+def add_to_sketch(sketch, count_dict):
+    """Add the token counts in count_dict to the sketch, and return it"""
+    tokens = count_dict.keys()
+    np.add.at(
+        sketch['table'], 
+        get_sketch_cells(sketch['table'].shape, tokens), 
+        np.array(count_dict.values(), dtype=np.int64)) # (add.at as tokens can share cells)
+    sketch['total'] += sum(count_dict.values())
+    sketch['heavy_hitters'] = merge_heavy_hitters(
+        sketch['num_heavy_hitters'], sketch['heavy_hitters'], count_dict, True)
+    return sketch
+
+def estimate_counts(sketch, tokens):
+    """Return an array of the estimated count of each of the tokens"""
+    if len(tokens) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return sketch['table'][get_sketch_cells(sketch['table'].shape, tokens)].min(axis=0)
+
+def merge_heavy_hitters(size, heavy_hitters_a, heavy_hitters_b, b_is_exact=False):
+    """Return the Space-Saving summary of the size most frequent tokens, 
+    from two summaries (or from a summary and exact counts)
+
+    A token that was dropped from a full summary could have been counted 
+    up to the summary's smallest count, so that is added for tokens that 
+    are missing from one of them."""
+    def smallest_count(heavy_hitters, is_exact):
+        """Return how many times a token missing from the summary might have 
+        been seen"""
+        if is_exact or len(heavy_hitters) < size:
+            return 0
+        return min(heavy_hitters.values())
+    missing_a = smallest_count(heavy_hitters_a, False)
+    missing_b = smallest_count(heavy_hitters_b, b_is_exact)
+    return tz.pipe(
+        set(heavy_hitters_a) | set(heavy_hitters_b),
+        tz.map(lambda x: (x, heavy_hitters_a.get(x, missing_a) + heavy_hitters_b.get(x, missing_b))),
+        lambda x: sorted(x, key=lambda y: (-y[1], y[0])),
+        lambda x: tz.take(size, x),
+        dict)
+
+def get_sketch_cells(shape, tokens):
+    """Return the (row, column) indexes of the sketch cells for each token,
+    as two (rows x tokens) arrays"""
+    depth, width = shape
+    hashes = np.array( # two 64 bit hashes of each token
+        [struct.unpack('<QQ', hashlib.md5(encode_token(x)).digest()) for x in tokens],
+        dtype=np.uint64).reshape(-1, 2)
+    rows = np.arange(depth, dtype=np.uint64)[:, None]
+    columns = (hashes[:, 0] + rows * hashes[:, 1]) % np.uint64(width) # a hash for each row
+    return (
+        np.broadcast_to(rows.astype(np.intp), columns.shape),
+        columns.astype(np.intp))
+
+def encode_token(token):
+    """Return the token as UTF-8 encoded bytes, for hashing"""
+    if isinstance(token, unicode):
+        return token.encode('utf8')
+    return token
+
+def build_sketch_matrix(sketches):
+    """Return a vocabulary (sorted) of the heavy hitters in the given sketches,
+    a matrix of their estimated counts with a row for each sketch, and the 
+    total number of tokens in each sketch"""
+    vocabulary = sorted(set(tz.concat(x['heavy_hitters'] for x in sketches)))
+    count_matrix = np.array(
+        [estimate_counts(x, vocabulary) for x in sketches], 
+        dtype=np.int64).reshape(len(sketches), len(vocabulary))
+    return vocabulary, count_matrix, np.array([x['total'] for x in sketches], dtype=np.int64)
+
 ## Helper Functions
+READ_CHUNK_SIZE = 5000 # rows read from the database (and parsed for the cache) at a time
+
 def get_content(db_engine, stream_name, date_range):
-    """Return content saved from the given stream in the given data range"""
+    """Iterate over (row_id, timestamp, content) for each entry saved from 
+    the given stream in the given date range, in time order
+
+    The rows are read READ_CHUNK_SIZE at a time, in one range scan of the 
+    time column's index."""
+    date_column, content_column = get_stream_columns(stream_name)
+    query = sqlal.text("""
+        select rowid, {date_column}, {content_column}
+        from {stream_name} 
+        where {date_column} >= :lower_date and {date_column} < :upper_date
+        order by {date_column}""".format(
+            stream_name = quote_name(stream_name),
+            date_column = quote_name(date_column),
+            content_column = quote_name(content_column)))
+    connection = db_engine.connect()
+    try:
+        rows = connection.execution_options(stream_results=True).execute(
+            query, lower_date=date_range[0], upper_date=date_range[1])
+        for chunk in iter(lambda: rows.fetchmany(READ_CHUNK_SIZE), []):
+            for row in chunk:
+                yield tuple(row)
+    finally:
+        connection.close()
+
+def read_in_windows(db_engine, date_range):
+    """Return a function that iterates over the content of a stream in a 
+    time step, content_in_window(stream_name, time_step_range)
+
+    Each stream is read in one ordered scan over the given date_range, 
+    so the time steps of each stream must be asked for in order, and each
+    one read completely before the next."""
+    scans = {} # stream_name: the rows and the first row past the last time step
+    def content_in_window(stream_name, window):
+        """Iterate over the content of the stream in the time step"""
+        if stream_name not in scans:
+            scans[stream_name] = {
+                'rows': get_content(db_engine, stream_name, date_range),
+                'next_row': None}
+        scan = scans[stream_name]
+        while True:
+            row = scan['next_row'] or next(scan['rows'], None)
+            scan['next_row'] = None
+            if row is None: # no more rows
+                return
+            elif row[1] < window[0]: # before this time step
+                continue
+            elif row[1] >= window[1]: # for a later time step
+                scan['next_row'] = row
+                return
+            yield row[2]
+    return content_in_window
+
+def get_stream_columns(stream_name):
+    """Return the date and content columns of the given stream"""
     if stream_name in ['tweets', 'tweets_debate']:
-        date_column = 'created_at'
-        content_column = 'text'
+        return 'created_at', 'text'
     else:
-        date_column = 'published'
-        content_column = 'content'
-    query = """
-        select * 
-        from {stream_name} 
-        where {date_column} >= '{lower_date}' and {date_column} < '{upper_date}'"""\
-            .format(stream_name = stream_name,
-                    date_column = date_column,
-                    lower_date = date_range[0], 
-                    upper_date = date_range[1])
-    returned_table = pd.read_sql_query(query, db_engine)
-    return returned_table[content_column].tolist()
+        return 'published', 'content'
 
 @tz.curry
 @timed
-def parse_content_into_count(max_num_words, allowed_parts_of_speech, list_of_content):
-    """Return a dictionary of tokens (as keys) and counts (as values)"""
-    def is_english(s):
-        """Predicate that estimates whether a given string is in English"""
-        try: 
-            return langdetect.detect(s) == 'en'
-        except:
-            print("Couldn't detect the language of: {}".format(s))
-            return True
-    @tz.curry
-    def tokenize_and_filter_perc_func(allowed_parts_of_speech, given_text):
-        """Return the tokens in the given text that are the allowed parts
-        of speech
-
-        This version uses the faster PerceptronTagger"""
-        return tz.pipe(
-            given_text,
-            lambda x: TextBlob(x, pos_tagger=PerceptronTagger()),
-            lambda x: x.tags,
-            tz.filter(lambda x: x[1] in allowed_parts_of_speech), 
-                # limit to allowed parts of speech
-            tz.map(lambda x: x[0]), # return only the token
-            list, 
-        )
-    @tz.curry
-    def tokenize_and_filter_nltk_func(allowed_parts_of_speech, given_text):
-        """Return the tokens in the given text that are the allowed parts
-        of speech
+def parse_content_into_count(allowed_parts_of_speech, pool, list_of_content):
+    """Return a dictionary of tokens (as keys) and counts (as values)
 
-        This version uses the recommended tagger from NLTK, it is relatively
-        slow."""
-        return tz.pipe(
-            given_text,
-            nltk.word_tokenize,
-            lambda x: nltk.pos_tag(x),
-            tz.filter(lambda x: x[1] in allowed_parts_of_speech), 
-                # limit to allowed parts of speech
-            tz.map(lambda x: x[0]), # return only the token
-            list, 
-            print_and_pass)
+    If a pool of worker processes is given, the documents are cleaned, and
+    the chunks of them are tokenized, across its workers. The chunks are 
+    made in the same order either way, so the counts are identical to 
+    parsing serially (with pool as None)."""
+    return tz.pipe(
+        list_of_content, # given content
+        map_with_pool(pool, clean_document), # remove html and urls, or None if not English
+        tz.filter(lambda x: x is not None), # limit to English entries
+        chunk_string(500), # this is done to speedup the part of speech tagging
+        map_with_pool(pool, functools.partial(count_tokens, allowed_parts_of_speech)),
+        lambda x: tz.merge_with(sum, list(x))) # combine the counts of each chunk
+
+@tz.curry
+@timed
+def parse_content_into_sketch(sketch_settings, allowed_parts_of_speech, pool, list_of_content):
+    """Return a sketch of the token counts in the given content, as 
+    parse_content_into_count does, but in a fixed amount of memory"""
+    return tz.pipe(
+        list_of_content, # given content
+        map_with_pool(pool, clean_document), # remove html and urls, or None if not English
+        tz.filter(lambda x: x is not None), # limit to English entries
+        chunk_string(500), # this is done to speedup the part of speech tagging
+        map_with_pool(pool, functools.partial(count_tokens, allowed_parts_of_speech)),
+        lambda x: reduce(add_to_sketch, x, new_sketch(**sketch_settings))) # add each chunk's counts
+
+def parse_content_into_counts(allowed_parts_of_speech, pool, list_of_content):
+    """Return a list with a dictionary of token counts for each of the given
+    documents, or None for those that aren't in English"""
+    return tz.pipe(
+        list_of_content,
+        map_with_pool(pool, functools.partial(parse_document, allowed_parts_of_speech)),
+        list)
+
+def parse_document(allowed_parts_of_speech, given_text):
+    """Return a dictionary of the token counts in the given document, or 
+    None if it isn't in English"""
+    text = clean_document(given_text)
+    if text is None:
+        return None
+    return count_tokens(allowed_parts_of_speech, text)
+
+def clean_document(given_text):
+    """Return the text of the given document without html or urls, or None
+    if it doesn't seem to be in English"""
+    text = strip_html(given_text or '')
+    if not is_english(text):
+        return None
+    return URL_PATTERN.sub("", text) # remove urls
+
+HTML_TAG_PATTERN = re.compile(
+    r'<(script|style)\b.*?</\1\s*>'                   # scripts and styles, with their contents
+    r'|<!\[CDATA\[.*?\]\]>'                           # CDATA blocks
+    r'|<!--.*?-->'                                    # comments
+    r'|<[a-zA-Z/!](?:[^>"\']|"[^"]*"|\'[^\']*\')*>',   # tags, whose quoted values may have a >
+    re.DOTALL | re.IGNORECASE)
+URL_PATTERN = re.compile(r'http\S*')
+WORD_CHARACTER_PATTERN = re.compile(r'\w')
+HTML_PARSER = HTMLParser.HTMLParser() # for its unescape
+
+def strip_html(given_text):
+    """Return the text of the given html, without its tags (or scripts, 
+    styles, CDATA and comments) and with any entities (such as &amp;) 
+    unescaped"""
+    if '<' not in given_text and '&' not in given_text: # no markup (as in most tweets)
+        return given_text
+    return HTML_PARSER.unescape(HTML_TAG_PATTERN.sub("", given_text))
+
+def count_tokens(allowed_parts_of_speech, given_text):
+    """Return a dictionary of the tokens in the given text (as keys) and 
+    their counts (as values)"""
     if allowed_parts_of_speech == "all":
         # Don't even tag parts of speech, just use everything
-        tokenize_func = lambda x: nltk.word_tokenize(x)
+        tokens = nltk.word_tokenize(given_text)
     else: 
-        tokenize_func = tokenize_and_filter_perc_func(allowed_parts_of_speech)
-    wordnet_lemmatizer = nltk.stem.WordNetLemmatizer()
-    lemma_fun = lambda x: wordnet_lemmatizer.lemmatize(x)
+        tokens = tokenize_and_filter_perc_func(allowed_parts_of_speech, given_text)
+    lemmatizer = load_nlp_models()['lemmatizer']
     exclusion_list = ['//platform.twitter.com/widgets.js', 'align=', 'aligncenter', 'id=', 'width=', '/caption', 'pdf.pdf', u'//t.c\xe2rt', 'http']
         # Yeah, this is a bit of a hack
     return tz.pipe(
-        list_of_content, # given content
-        tz.map(lambda x: BeautifulSoup(x, 'html.parser').get_text()), # remove html in string
-        tz.filter(is_english), # limit to English entries
-        tz.map(lambda x: re.sub(r'http.*?(?=\s)', "", x)), # remove urls
-        chunk_string(500), # this is done to speedup the part of speech tagging
-        tz.mapcat(tokenize_func), # tokenize, and maybe filter by part of speech
+        tokens,
         tz.filter(lambda x: x not in exclusion_list), # filter out specific tokens
-        tz.filter(lambda x: re.sub(r'\W', "", x) != ''), # filter out punctuation-only strings
+        tz.filter(WORD_CHARACTER_PATTERN.search), # filter out punctuation-only strings
         tz.map(lambda s: s.lower()), # convert to lower case
-        tz.map(lemma_fun), # convert tokens to a more standard lemma
+        tz.map(lambda x: memoized('lemmas', x, lemmatizer.lemmatize, x)), 
+            # convert tokens to a more standard lemma
         tz.countby(tz.identity)) # count occurrences
 
+def is_english(s):
+    """Predicate that estimates whether a given string is in English"""
+    return memoized('languages', hash_content(s), detect_language, s) == 'en'
+
+def detect_language(s):
+    """Return the code of the language the given string seems to be in, or
+    'en' if it can't tell"""
+    try: 
+        return langdetect.detect(s)
+    except:
+        print("Couldn't detect the language of: {}".format(s))
+        return 'en'
+
+@tz.curry
+def tokenize_and_filter_perc_func(allowed_parts_of_speech, given_text):
+    """Return the tokens in the given text that are the allowed parts
+    of speech
+
+    This version uses the faster PerceptronTagger"""
+    return tz.pipe(
+        given_text,
+        tag_parts_of_speech, # not memoized, since the text is often a whole chunk of documents
+        tz.filter(lambda x: x[1] in allowed_parts_of_speech), 
+            # limit to allowed parts of speech
+        tz.map(lambda x: x[0]), # return only the token
+        list, 
+    )
+
+def tag_parts_of_speech(given_text):
+    """Return (token, tag) pairs for the given text"""
+    return TextBlob(given_text, pos_tagger=load_nlp_models()['tagger']).tags
+
+@tz.curry
+def tokenize_and_filter_nltk_func(allowed_parts_of_speech, given_text):
+    """Return the tokens in the given text that are the allowed parts
+    of speech
+
+    This version uses the recommended tagger from NLTK, it is relatively
+    slow."""
+    return tz.pipe(
+        given_text,
+        nltk.word_tokenize,
+        lambda x: nltk.pos_tag(x),
+        tz.filter(lambda x: x[1] in allowed_parts_of_speech), 
+            # limit to allowed parts of speech
+        tz.map(lambda x: x[0]), # return only the token
+        list, 
+        print_and_pass)
+
 @tz.memoize
 def calculate_prior(num_tokens_all_streams, num_tokens_this_stream):
     """Calculate the prior probability that this token is from this stream"""
@@ -297,18 +771,24 @@ def count_total_tokens(count_dict):
 
 def get_top_tokens(n, count_dict):
     """Return the top n most frequent tokens in the count_dict
-    If n > len(count_dict), it will just return them all"""
+    If n > len(count_dict), it will just return them all. Ties are broken 
+    alphabetically, so the result doesn't depend on the dictionary's order"""
     return tz.pipe(
         count_dict,
         lambda x: x.items(),
-        lambda x: sorted(x, key=lambda y: -y[1]),
+        lambda x: sorted(x, key=lambda y: (-y[1], y[0])),
         lambda x: tz.take(n, x),
         list)
 
+OCCURANCE_MINIMUM = 5 # the number of times a token must occur (across streams) to be included
+
 def get_posterior_probs_freq(num_words, all_streams_count_dict, this_stream_count_dict):
     """Return the posterior probabilities for the num_words most frequent tokens
-    in this_stream_count_dict"""
-    occurance_minimum = 5 # the number of times a token must occur to be included
+    in this_stream_count_dict
+
+    This scores one token at a time, get_posterior_probs_matrix gives the same
+    results for every stream at once."""
+    occurance_minimum = OCCURANCE_MINIMUM
     return tz.pipe(
         get_top_tokens(num_words, this_stream_count_dict),
         tz.filter(lambda x: all_streams_count_dict[x[0]] >= occurance_minimum),
@@ -321,6 +801,55 @@ def get_posterior_probs_freq(num_words, all_streams_count_dict, this_stream_coun
                 x[0])}),
         lambda x: sorted(x, key=lambda y: -y['posterior']))
 
+def build_count_matrix(count_dicts):
+    """Return the vocabulary (sorted) across the given token count dictionaries,
+    a matrix of counts with a row for each dictionary and a column for 
+    each token, and the total number of tokens in each dictionary"""
+    vocabulary = sorted(set(tz.concat(count_dicts)))
+    token_index = dict((token, num) for num, token in enumerate(vocabulary))
+    count_matrix = np.zeros((len(count_dicts), len(vocabulary)), dtype=np.int64)
+    for row, count_dict in enumerate(count_dicts):
+        count_matrix[row, [token_index[x] for x in count_dict]] = count_dict.values()
+    return vocabulary, count_matrix, count_matrix.sum(axis=1)
+
+def get_posterior_probs_matrix(num_words, vocabulary, count_matrix, stream_totals, stream_num):
+    """Return the posterior probabilities for the num_words most frequent 
+    tokens in the given stream (row of the count_matrix), in the same order 
+    as get_posterior_probs_freq. stream_totals are the number of tokens in 
+    each stream (including any left out of the count_matrix)."""
+    all_streams_counts = count_matrix.sum(axis=0)
+    this_stream_counts = count_matrix[stream_num]
+    top_indexes = tz.pipe(
+        get_top_indexes(num_words, this_stream_counts),
+        lambda x: x[all_streams_counts[x] >= OCCURANCE_MINIMUM])
+    if len(top_indexes) == 0:
+        return []
+    num_tokens_all_streams = float(stream_totals.sum())
+    num_tokens_this_stream = float(stream_totals[stream_num])
+    # The same steps as calculate_posterior, so the values match exactly
+    prior = num_tokens_this_stream / num_tokens_all_streams
+    likelihood = this_stream_counts[top_indexes] / num_tokens_this_stream
+    evidence = all_streams_counts[top_indexes] / num_tokens_all_streams
+    posteriors = (prior * likelihood) / evidence
+    order = np.argsort(-posteriors, kind='mergesort') # stable, like sorted
+    return [
+        {'token': vocabulary[index], 
+         'occurrences': int(this_stream_counts[index]),
+         'posterior': float(posterior)}
+        for index, posterior in zip(top_indexes[order], posteriors[order])]
+
+def get_top_indexes(n, counts):
+    """Return the indexes of the n largest counts (leaving out zeros), from 
+    largest to smallest, with ties in the order of the indexes (as 
+    get_top_tokens does with an alphabetical vocabulary)"""
+    indexes = np.flatnonzero(counts > 0)
+    if n < len(indexes):
+        values = counts[indexes]
+        threshold = values[np.argpartition(-values, n - 1)[n - 1]] # the nth largest
+        above = indexes[values > threshold]
+        indexes = np.concatenate([ # with the earliest indexes of those tied at the threshold
+            above, indexes[values == threshold][:n - len(above)]])
+    return indexes[np.lexsort((indexes, -counts[indexes]))]
 
 def print_and_pass(x):
     """Simple function for peaking into data pipelines"""
@@ -330,14 +859,11 @@ def print_and_pass(x):
 @tz.curry
 def chunk_string(size, given_iterator):
     """Iterator function that takes an iterator of strings, and produces a stream
-    of *size* of them concatenated together"""
-    storage = ''
-    for num, x in enumerate(given_iterator):
-        storage = storage + x
-        if num % size == 0:
-            yield storage
-            storage = ''
-    yield storage
+    of *size* of them joined together (on separate lines)"""
+    return tz.pipe(
+        given_iterator,
+        tz.partition_all(size),
+        tz.map(lambda x: "\n".join(x)))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,117 @@
+## Save the events about given topics to their own tables
+##
+## The topics, and the terms for each, are defined in a YAML file (such as
+## data/demdebate/topics.yaml). Each stream's table is read once, and every
+## event is checked against all of the topics. The events about each topic
+## are then saved to a <stream>_<topic> table (such as comments_debate),
+## replacing any from an earlier run. It can be run with:
+## `python keyword_filter.py --topics ../../data/demdebate/topics.yaml`
+
+import sqlite3             # for reading and saving to SQLite
+import argparse            # for accepting command line arguments
+import yaml                # for reading the topic definitions
+import time                # for some simple benchmarking
+from load_to_db import quote_name, get_time_column # shared with the loader
+
+## Accept Arguments
+parser = argparse.ArgumentParser(description="Save the events about each topic to their own tables")
+parser.add_argument('--database', type=str, default="../../data/demdebate/demdebate.sqlite",
+                    help='The SQLite database with the stream tables')
+parser.add_argument('--topics', type=str, default="../../data/demdebate/topics.yaml",
+                    help='The YAML file defining the topics')
+
+## Main Functions
+def main():
+    args = parser.parse_args()
+    with open(args.topics) as f:
+        topic_config = yaml.safe_load(f)
+    topic_terms = compile_topics(topic_config['topics'])
+    connection = sqlite3.connect(args.database)
+    connection.text_factory = str # UTF-8 bytes, which are quicker to search
+    try:
+        for stream_name, text_columns in sorted(topic_config['text_columns'].items()):
+            filter_stream(connection, stream_name, text_columns, topic_terms)
+    finally:
+        connection.close()
+
+def filter_stream(connection, stream_name, text_columns, topic_terms):
+    """Save the events in the stream that are about each topic to a
+    <stream>_<topic> table, reading the stream's table only once"""
+    if not table_exists(connection, stream_name):
+        print("{:<12} not in the database, skipping it".format(stream_name))
+        return False
+    start_time = time.time()
+    connection.execute("CREATE TEMP TABLE IF NOT EXISTS matched_rows (topic TEXT, row_id INTEGER)")
+    connection.execute("DELETE FROM matched_rows")
+    num_rows = 0
+    rows = connection.execute( # the text columns, joined and in lower case
+        "SELECT rowid, lower({}) FROM {}".format(
+            " || char(10) || ".join("coalesce({}, '')".format(quote_name(x)) for x in text_columns),
+            quote_name(stream_name)))
+    for chunk in iter(lambda: rows.fetchmany(10000), []):
+        connection.executemany("INSERT INTO matched_rows VALUES (?, ?)", [
+            (topic, row_id)
+            for row_id, text in chunk
+            for topic in find_topics(topic_terms, text)])
+        num_rows += len(chunk)
+    columns = [
+        x[1] for x in connection.execute("PRAGMA table_info({})".format(quote_name(stream_name)))]
+    for topic, _ in topic_terms:
+        num_matched = save_topic_table(
+            connection, stream_name, topic, get_time_column(columns))
+        print("{:<12} {:<12} {:>10} of {:>10} events {:>10,.0f} events/sec".format(
+            stream_name, topic, num_matched, num_rows,
+            num_rows / max(time.time() - start_time, 1e-6)))
+    connection.commit()
+    return True
+
+## Matching Functions
+def compile_topics(topics):
+    """Return (topic, terms) pairs, with the terms lower case and UTF-8
+    encoded for find_topics"""
+    return [
+        (topic, [x.lower().encode('utf8') for x in terms])
+        for topic, terms in sorted(topics.items())]
+
+def find_topics(topic_terms, text):
+    """Return the topics whose terms appear in the given text, which should
+    be UTF-8 encoded and in lower case. As with LIKE, terms can be part of
+    longer words"""
+    return [
+        topic for topic, terms in topic_terms
+        if any_term_in(terms, text)]
+
+def any_term_in(terms, text):
+    """Return whether any of the terms are in the text"""
+    for term in terms:
+        if term in text:
+            return True
+    return False
+
+## Helper Functions
+def save_topic_table(connection, stream_name, topic, time_column):
+    """Replace the <stream>_<topic> table with the rows matched to the
+    topic, and return how many there are"""
+    topic_table = "{}_{}".format(stream_name, topic)
+    connection.execute("DROP TABLE IF EXISTS {}".format(quote_name(topic_table)))
+    connection.execute(
+        "CREATE TABLE {} AS SELECT * FROM {} WHERE rowid IN "
+        "(SELECT row_id FROM matched_rows WHERE topic = ?) ORDER BY rowid".format(
+            quote_name(topic_table), quote_name(stream_name)),
+        (topic,))
+    if time_column is not None: # for looking up time ranges
+        connection.execute("CREATE INDEX {} ON {} ({})".format(
+            quote_name("{}_{}".format(topic_table, time_column)),
+            quote_name(topic_table),
+            quote_name(time_column)))
+    return connection.execute(
+        "SELECT count(*) FROM {}".format(quote_name(topic_table))).fetchone()[0]
+
+def table_exists(connection, table_name):
+    """Return whether the database has the given table"""
+    return connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (table_name,)).fetchone() is not None
+
+if __name__ == '__main__':
+    main()
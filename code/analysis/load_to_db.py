@@ -1,10 +1,84 @@
-import sqlalchemy as sqlal # for connecting to databases
-import pandas as pd        # for data wrangling
-import unicodecsv as csv   # for saving to CSV in UTF-8 by default
-import toolz.curried as tz # functional programming library
-import gzip                # for compression of CSV output
+## Load the compressed CSV files saved by the stream consumers into SQLite
+##
+## The files are decompressed and parsed by a pool of worker processes,
+## which pass chunks of rows to this process. It is the only one writing to
+## the database, and uses a single connection with large transactions.
+##
+## A ledger table (loaded_files) records how far into each file has been
+## loaded, so running it again only loads new files and whatever has been
+## added to the end of the others. Rows that are already in the database
+## (by each stream's natural key) are skipped, so it is safe to run again
+## after a failure, or every few minutes while the consumers are running.
+##
+## The tables have typed columns, an epoch column (seconds since 1970, UTC)
+## and indexes on their time columns. Each also has a <table>_per_minute
+## table of the number of events in each minute, which a trigger keeps up
+## to date as rows are loaded.
+##
+## It can be run with: `python load_to_db.py [files, folders or globs ...]`
+
+import sqlite3             # for saving to SQLite
+import unicodecsv as csv   # for reading CSV in UTF-8 by default
+import multiprocessing     # for parsing files in parallel
+import argparse            # for accepting command line arguments
+import datetime as dt      # for recording when files were loaded
+import calendar            # for converting times to epoch seconds
+import glob                # for finding the files to load
+import zlib                # for decompressing the gzip members directly
+import json                # for saving the columns in the ledger
 import time                # for some simple benchmarking
 import sys                 # for interacting with the system
+import os                  # for working with file paths
+import Queue               # for the exception when the chunk queue is empty
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS # tells zlib to expect a gzip header
+READ_SIZE = 2**20                # bytes read from a file at a time
+QUEUE_TIMEOUT = 1                # seconds between checks on the workers
+
+# The columns that identify an event of each stream, so it is only saved once
+NATURAL_KEYS = {
+    'tweets': ('user_id', 'timestamp_ms'),
+    'filtered_tweets': ('user_id', 'timestamp_ms'),
+    'comments': ('id', 'verb', 'published'),
+    'posts': ('permalinkUrl', 'verb', 'published'),
+    'likes': ('actor_id', 'url', 'published')}
+
+# The columns of each stream that aren't saved as TEXT, matching the types 
+# in the consumers' field plans (int64 as INTEGER, bool as BOOLEAN)
+COLUMN_TYPES = {
+    'tweets': {
+        'created_at_ms': 'INTEGER',
+        'user_id': 'INTEGER',
+        'user_favourites': 'INTEGER',
+        'count_urls': 'INTEGER',
+        'count_media': 'INTEGER',
+        'is_quote_status': 'BOOLEAN',
+        'is_reply': 'BOOLEAN',
+        'is_retweet': 'BOOLEAN'},
+    'posts': {
+        'content_len': 'INTEGER',
+        'actor_id': 'INTEGER'},
+    'comments': {
+        'content_len': 'INTEGER',
+        'target_wpCommentCount': 'INTEGER'}, # its actor_id isn't a number
+    'likes': {
+        'actor_id': 'INTEGER'}}
+COLUMN_TYPES['filtered_tweets'] = COLUMN_TYPES['tweets']
+
+TIME_COLUMNS = ['published', 'created_at'] # when each event happened
+
+## Accept Arguments
+parser = argparse.ArgumentParser(description="Load stream CSV files into SQLite")
+parser.add_argument('paths', type=str, nargs='*', default=["../../data/demdebate/"],
+                    help='.csv.gz files, folders of them, or globs (default: ../../data/demdebate/)')
+parser.add_argument('--database', type=str, default="../../data/demdebate/demdebate.sqlite",
+                    help='The SQLite database to load them into')
+parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                    help='The number of files to parse at once')
+parser.add_argument('--chunk_size', type=int, default=5000,
+                    help='The number of rows passed from a worker at a time')
+parser.add_argument('--transaction_size', type=int, default=200000,
+                    help='The number of rows inserted in each transaction')
 
 ## Decorators
 def timed(func):
@@ -20,63 +94,424 @@ def timed(func):
 ## Main Functions
 @timed
 def main():
-    file_base = "../../data/demdebate/"
-    database = "demdebate.sqlite"
-    file_information = {
-        'comments': {
-            'csv_gz': "comments_stream_2015-10-13_09-03-40.csv.gz",
-            'table_name': 'comments'},
-        'likes': {
-            'csv_gz': "likes_stream_2015-10-13_09-03-40.csv.gz",
-            'table_name': 'likes'},
-        'posts': {
-            'csv_gz': "posts_stream_2015-10-13_09-03-40.csv.gz",
-            'table_name': 'posts'},
-        'tweets': {
-            'csv_gz': "tweets_stream_2015-10-13_09-03-40.csv.gz",
-            'table_name': 'tweets'}}
-    keys = ['comments', 'likes', 'posts', 'tweets']
-    for key in keys:
-        try: 
-            transfer_csvgz_sqlite(
-                "{}{}".format(file_base, file_information[key]['csv_gz']),
-                file_information[key]['table_name'],
-                "{}{}".format(file_base, database))
-        except IOError:
-            # These files are presently truncated, so when it gets to the end
-            # of the file it discovers that the last bit is broken.
-            pass
-
-def transfer_csvgz_sqlite(file_name, table_name, save_location):
-    """Transfer data from a gzipped CSV file to a SQLite database for
-    easier wrangling."""
-    saveing_function = save_to_sqlite(table_name, save_location)
-    load_csvgz_in_chunks(file_name, saveing_function)
+    args = parser.parse_args()
+    file_names = find_csvgz_files(args.paths)
+    print("Found {} files to load into {}".format(len(file_names), args.database))
+    load_files(file_names, args.database, args.processes, args.chunk_size,
+               args.transaction_size)
+
+def load_files(file_names, save_location, processes, chunk_size, transaction_size):
+    """Parse the new parts of the given files in worker processes, and save
+    their rows to the SQLite database as they arrive. Returns the number of
+    new rows saved"""
+    connection = sqlite3.connect(save_location)
+    try:
+        tasks = find_new_data(file_names, read_ledger(connection), chunk_size)
+        if len(tasks) == 0:
+            print("Every file is already loaded")
+            return 0
+        chunk_queue = multiprocessing.Queue(maxsize=4 * processes) # bounds memory use
+        pool = multiprocessing.Pool(
+            processes, initializer=set_chunk_queue, initargs=(chunk_queue,))
+        async_result = pool.map_async(parse_csvgz_file, tasks, chunksize=1)
+        pool.close()
+        try:
+            return save_chunks(
+                connection, chunk_queue, async_result, len(tasks), transaction_size)
+        finally:
+            pool.terminate()
+    finally:
+        connection.close()
+
+def save_chunks(connection, chunk_queue, async_result, num_files, transaction_size):
+    """Insert the chunks of rows from the queue until each file has
+    finished, committing every transaction_size rows"""
+    insert_statements = {} # (table, columns) -> insert statement
+    new_rows = {}          # file -> number of rows that weren't already saved
+    uncommitted_rows = 0
+    files_finished = 0
+    while files_finished < num_files:
+        file_name, table_name, columns, rows, byte_offset = get_chunk(chunk_queue, async_result)
+        new_rows.setdefault(file_name, 0)
+        if isinstance(rows, dict): # the file has been read, and this is its summary
+            record_in_ledger(connection, file_name, table_name, columns, byte_offset, 0, 0)
+            files_finished += 1
+            connection.commit() # so the reported rate includes saving them
+            uncommitted_rows = 0
+            report_file(file_name, rows, new_rows[file_name])
+            continue
+        key = (table_name, columns)
+        if key not in insert_statements:
+            insert_statements[key] = create_sqlite_table(connection, table_name, columns)
+        num_saved = connection.executemany(insert_statements[key], rows).rowcount
+        new_rows[file_name] += num_saved
+        # In the same transaction, so the ledger always matches the tables
+        record_in_ledger(
+            connection, file_name, table_name, columns, byte_offset, len(rows), num_saved)
+        uncommitted_rows += len(rows)
+        if uncommitted_rows >= transaction_size:
+            connection.commit()
+            uncommitted_rows = 0
+    connection.commit()
+    return sum(new_rows.values())
+
+def get_chunk(chunk_queue, async_result):
+    """Return the next chunk from the queue, raising the workers' error 
+    (rather than waiting forever) if they have stopped without sending it"""
+    while True:
+        workers_finished = async_result.ready() # before waiting, so their last chunks can arrive
+        try:
+            return chunk_queue.get(timeout=QUEUE_TIMEOUT)
+        except Queue.Empty:
+            if workers_finished:
+                async_result.get() # raises the error from the worker, if there was one
+                raise RuntimeError("The workers finished without sending every file")
+
+## Worker Functions
+def set_chunk_queue(chunk_queue):
+    """Give a worker process the queue for passing back rows"""
+    global CHUNK_QUEUE
+    CHUNK_QUEUE = chunk_queue
+
+def parse_csvgz_file(arguments):
+    """Read a gzipped CSV file from the given byte offset, and put chunks of
+    its rows on the queue, followed by a summary of how it went"""
+    file_name, byte_offset, columns, chunk_size = arguments
+    table_name = get_table_name(file_name)
+    summary = {'rows': 0, 'started': time.time(), 'error': None}
+    position = {'byte_offset': byte_offset} # the end of the last complete member read
+    try:
+        for columns, rows in load_csvgz_in_chunks(file_name, position, columns, chunk_size):
+            CHUNK_QUEUE.put((
+                file_name, table_name, columns, convert_rows(table_name, columns, rows),
+                position['byte_offset']))
+            summary['rows'] += len(rows)
+    except Exception as e:
+        # Such as the file being cut off by the consumer being killed, so
+        # keep what was read before the damaged part
+        summary['error'] = repr(e)
+    else:
+        if position['byte_offset'] < os.path.getsize(file_name):
+            summary['error'] = "the end of the file is incomplete"
+    CHUNK_QUEUE.put((file_name, table_name, columns, summary, position['byte_offset']))
+
+## Ledger Functions
+def read_ledger(connection):
+    """Return {file name: (byte offset, columns)} for the files that have
+    already been (at least partly) loaded"""
+    connection.execute("""CREATE TABLE IF NOT EXISTS loaded_files (
+        file_name TEXT PRIMARY KEY,
+        table_name TEXT,
+        columns TEXT,
+        byte_offset INTEGER,
+        rows_read INTEGER,
+        rows_loaded INTEGER,
+        loaded_at TEXT)""")
+    connection.commit()
+    return {
+        x[0]: (x[1], None if x[2] is None else tuple(json.loads(x[2])))
+        for x in connection.execute(
+            "SELECT file_name, byte_offset, columns FROM loaded_files")}
+
+def find_new_data(file_names, ledger, chunk_size):
+    """Return the arguments for parse_csvgz_file for each file that has
+    data that hasn't been loaded yet"""
+    tasks = []
+    for file_name in file_names:
+        byte_offset, columns = ledger.get(os.path.basename(file_name), (0, None))
+        file_size = os.path.getsize(file_name)
+        if byte_offset == file_size:
+            continue # nothing new
+        elif byte_offset > file_size or columns is None: # it was replaced
+            byte_offset, columns = 0, None
+        tasks.append((file_name, byte_offset, columns, chunk_size))
+    return tasks
+
+def record_in_ledger(connection, file_name, table_name, columns, byte_offset, rows_read, rows_loaded):
+    """Record how far into a file has been loaded"""
+    connection.execute(
+        "INSERT OR IGNORE INTO loaded_files VALUES (?, ?, NULL, 0, 0, 0, NULL)",
+        (os.path.basename(file_name), table_name))
+    connection.execute("""UPDATE loaded_files SET
+        columns = ?,
+        byte_offset = ?,
+        rows_read = rows_read + ?,
+        rows_loaded = rows_loaded + ?,
+        loaded_at = ?
+        WHERE file_name = ?""", (
+            None if columns is None else json.dumps(columns),
+            byte_offset,
+            rows_read,
+            rows_loaded,
+            dt.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+            os.path.basename(file_name)))
+
+## Converting Functions
+def convert_rows(table_name, columns, rows):
+    """Convert each value in the rows (in place) to its column's type, and 
+    add the epoch seconds of the row's time column to the end"""
+    column_types = get_column_types(table_name)
+    typed_columns = [
+        (num, CONVERTERS[column_types[x]]) 
+        for num, x in enumerate(columns) if x in column_types]
+    time_column = get_time_column(columns)
+    time_index = None if time_column is None else columns.index(time_column)
+    for row in rows:
+        for num, converter in typed_columns:
+            row[num] = converter(row[num])
+        if time_index is not None:
+            row.append(convert_to_epoch(row[time_index]))
+    return rows
+
+def int_or_none(given_string):
+    """Return the integer in the string, or None if it is empty"""
+    try:
+        return int(given_string)
+    except ValueError:
+        return None
+
+def bool_or_none(given_string):
+    """Return 1 or 0 for the 'True' or 'False' in the string, or None"""
+    return BOOLEAN_VALUES.get(given_string, None)
+
+BOOLEAN_VALUES = {'True': 1, 'False': 0}
+
+CONVERTERS = {'INTEGER': int_or_none, 'BOOLEAN': bool_or_none}
+
+def convert_to_epoch(date_string):
+    """Return the seconds since 1970 for a date-time stamp such as
+    2015-10-04T23:37:53Z, or None if it isn't one"""
+    try:
+        minute = date_string[:16]
+        if minute not in EPOCH_MINUTES: # each minute is only worked out once
+            if len(EPOCH_MINUTES) >= 100000:
+                EPOCH_MINUTES.clear()
+            EPOCH_MINUTES[minute] = calendar.timegm((
+                int(minute[0:4]), int(minute[5:7]), int(minute[8:10]),
+                int(minute[11:13]), int(minute[14:16]), 0))
+        return EPOCH_MINUTES[minute] + int(date_string[17:19])
+    except ValueError:
+        return None
+
+EPOCH_MINUTES = {} # the epoch seconds at the start of each minute
+
+def get_time_column(columns):
+    """Return the column that has the time of each event, or None"""
+    return next((x for x in TIME_COLUMNS if x in columns), None)
+
+def get_table_columns(columns):
+    """Return the columns that the table has for the given CSV columns"""
+    if get_time_column(columns) is None:
+        return columns
+    return columns + ('epoch',)
+
+## Schema Functions
+def create_sqlite_table(connection, table_name, columns):
+    """Create the table (if it doesn't already exist), add any of the
+    columns it is missing, along with its indexes and per-minute counts,
+    and return the statement for inserting rows"""
+    table_columns = get_table_columns(columns)
+    connection.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(
+        quote_name(table_name), ", ".join(
+            "{} {}".format(quote_name(x), get_column_type(table_name, x)) for x in table_columns)))
+    existing_columns = [
+        x[1] for x in connection.execute("PRAGMA table_info({})".format(quote_name(table_name)))]
+    for column in table_columns:
+        if column not in existing_columns: # such as from an older consumer
+            connection.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                quote_name(table_name), quote_name(column), get_column_type(table_name, column)))
+    create_natural_key_index(connection, table_name)
+    time_column = get_time_column(columns)
+    if time_column is not None:
+        for column in [time_column, 'epoch']:
+            connection.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(
+                quote_name("{}_{}".format(table_name, column)),
+                quote_name(table_name),
+                quote_name(column)))
+        create_per_minute_table(connection, table_name, time_column)
+    return "INSERT OR IGNORE INTO {} ({}) VALUES ({})".format(
+        quote_name(table_name),
+        ", ".join(quote_name(x) for x in table_columns),
+        ", ".join("?" for _ in table_columns))
+
+def get_column_type(table_name, column):
+    """Return the SQLite type for a column of the table"""
+    if column == 'epoch':
+        return 'INTEGER'
+    return get_column_types(table_name).get(column, 'TEXT')
+
+def get_column_types(table_name):
+    """Return the column types of the table's stream"""
+    return COLUMN_TYPES.get(get_stream_name(table_name), {})
+
+def get_stream_name(table_name):
+    """Return the stream that a table is from, such as posts for posts, 
+    posts_unmatched or posts_debate (or None if it isn't from a stream)"""
+    return next(
+        (x for x in sorted(NATURAL_KEYS, key=len, reverse=True) 
+         if table_name == x or table_name.startswith(x + "_")),
+        None)
+
+def create_per_minute_table(connection, table_name, time_column):
+    """Create the table of the number of events in each minute, and the
+    trigger that updates it as rows are added"""
+    per_minute_table = "{}_per_minute".format(table_name)
+    if connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (per_minute_table,)).fetchone() is not None:
+        return False
+    minute_of = "substr({}, 1, 16)".format # such as 2015-10-13T21:03
+    connection.execute(
+        "CREATE TABLE {} (minute TEXT PRIMARY KEY, num_entries INTEGER)".format(
+            quote_name(per_minute_table)))
+    connection.execute( # count the rows that are already there
+        "INSERT INTO {} SELECT {}, count(*) FROM {} WHERE {} IS NOT NULL GROUP BY 1".format(
+            quote_name(per_minute_table), minute_of(quote_name(time_column)), quote_name(table_name),
+            quote_name(time_column)))
+    connection.execute("""CREATE TRIGGER {trigger} AFTER INSERT ON {table}
+        WHEN NEW.{time_column} IS NOT NULL
+        BEGIN
+            INSERT OR IGNORE INTO {per_minute_table} VALUES ({minute}, 0);
+            UPDATE {per_minute_table} SET num_entries = num_entries + 1
+            WHERE minute = {minute};
+        END""".format(
+            trigger=quote_name("{}_count_per_minute".format(table_name)),
+            table=quote_name(table_name),
+            time_column=quote_name(time_column),
+            per_minute_table=quote_name(per_minute_table),
+            minute=minute_of("NEW." + quote_name(time_column))))
+    return True
+
+def create_natural_key_index(connection, table_name):
+    """Add a unique index on the table's natural key, so each event is only
+    saved once. Duplicates from earlier loads are removed first (and the
+    per-minute counts that included them are counted again)"""
+    index_name = "{}_natural_key".format(table_name)
+    natural_key = NATURAL_KEYS.get(get_stream_name(table_name))
+    if natural_key is None or connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+            (index_name,)).fetchone() is not None:
+        return False
+    key_columns = ", ".join(quote_name(x) for x in natural_key)
+    num_removed = connection.execute(
+        "DELETE FROM {0} WHERE rowid NOT IN (SELECT min(rowid) FROM {0} GROUP BY {1})".format(
+            quote_name(table_name), key_columns)).rowcount
+    if num_removed > 0: # made again by create_per_minute_table
+        connection.execute("DROP TRIGGER IF EXISTS {}".format(
+            quote_name("{}_count_per_minute".format(table_name))))
+        connection.execute("DROP TABLE IF EXISTS {}".format(
+            quote_name("{}_per_minute".format(table_name))))
+    connection.execute("CREATE UNIQUE INDEX {} ON {} ({})".format(
+        quote_name(index_name), quote_name(table_name), key_columns))
+    return True
 
 ## Helper Functions
-def load_csvgz_in_chunks(file_name, saveing_function):
-    """Load data from a gzipped CSV and pass it to a save function
-    in chunks."""
+def find_csvgz_files(paths):
+    """Return the .csv.gz files in the given files, folders and globs"""
+    file_names = []
+    for path in paths:
+        if os.path.isdir(path):
+            path = os.path.join(path, "*_stream*.csv.gz")
+        file_names += sorted(glob.glob(path))
+    return [
+        x for x in file_names
+        if x.endswith(".csv.gz") and not x.endswith(".recovered.csv.gz")]
+
+def get_table_name(file_name):
+    """Return the table for a file, such as comments for
+    comments_stream_2015-10-13_09-03-40.csv.gz"""
+    return os.path.basename(file_name).split("_stream")[0]
+
+def load_csvgz_in_chunks(file_name, position, columns, chunk_size):
+    """Yield (columns, rows) pairs for a gzipped CSV, starting from
+    position['byte_offset'], with each row as a list and at most chunk_size
+    rows in each pair. When starting at 0, the columns are read from the
+    header instead
+
+    position['byte_offset'] is kept at the end of the last complete gzip
+    member whose rows have all been yielded (or are in the pair being
+    yielded)."""
     csv.field_size_limit(sys.maxsize)
-    chunk_size = 3000
-    with gzip.open(file_name, "r") as f :
-        stored_stream = []
-        reader = csv.DictReader(f)
-        for num, row in enumerate(reader):
+    reader = csv.reader( # strict, so a cut off row raises
+        iterate_lines(iterate_members(file_name, position['byte_offset']), position),
+        strict=True)
+    if position['byte_offset'] == 0:
+        columns = tuple(next(reader)) # the header
+    stored_stream = []
+    try:
+        for row in reader:
+            if len(row) != len(columns):
+                raise csv.Error("A row was cut off")
             stored_stream.append(row)
-            if (num % chunk_size) == 0 and num != 0:
-                saveing_function(stored_stream)
+            if len(stored_stream) >= chunk_size:
+                yield columns, stored_stream
                 stored_stream = []
-    return True
+    except Exception as e:
+        if len(stored_stream) > 0:
+            yield columns, stored_stream # the rows before the damaged part
+        raise e
+    if len(stored_stream) > 0:
+        yield columns, stored_stream
 
-@tz.curry
-def save_to_sqlite(table, save_location, list_of_dictionaries):
-    """Save the given list of dictionaries to the specified SQLite database"""
-    db_engine = sqlal.create_engine('sqlite:///{}'.format(save_location))
-    given_df = pd.DataFrame(list_of_dictionaries)
-    given_df = given_df[sorted(given_df.columns.tolist())]
-    given_df.to_sql(table, db_engine, if_exists='append', index=False)
-    return True
+def iterate_members(file_name, byte_offset):
+    """Yield (text, member_end) pairs of the decompressed data in a gzip
+    file, starting at byte_offset. member_end is the byte offset just after
+    a gzip member once it is complete, and None otherwise"""
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    with open(file_name, "rb") as f:
+        f.seek(byte_offset)
+        for data in iter(lambda: f.read(READ_SIZE), ''):
+            while len(data) > 0:
+                text = decompressor.decompress(data)
+                # Anything after the end of a member is the start of the next
+                unused_data = decompressor.unused_data
+                byte_offset += len(data) - len(unused_data)
+                if len(unused_data) > 0:
+                    yield text, byte_offset
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+                else:
+                    yield text, None
+                data = unused_data
+    # The last member is only complete if anything after it would be unused
+    probe = decompressor.copy()
+    probe.decompress('\x00')
+    if len(probe.unused_data) > 0:
+        yield '', byte_offset
+
+def iterate_lines(pieces, position):
+    """Yield the complete lines in the (text, member_end) pairs, moving
+    position['byte_offset'] to the end of each member once its last line
+    has been passed on
+
+    The lines of a member are only passed on once the member is complete,
+    so the rows of one that is still being written are loaded (once) by a
+    later run, rather than now and again from the same byte offset."""
+    remainder = ''
+    member_lines = [] # the complete lines of the members that aren't complete yet
+    for text, member_end in pieces:
+        lines = (remainder + text).split('\n')
+        remainder = lines.pop()
+        member_lines.extend(lines)
+        if member_end is not None:
+            for line in member_lines:
+                yield line + '\n'
+            member_lines = []
+            if remainder == '':
+                position['byte_offset'] = member_end
+
+def quote_name(name):
+    """Quote a table or column name for use in SQL"""
+    return '"{}"'.format(name.replace('"', '""'))
+
+def report_file(file_name, summary, new_rows):
+    """Print how many rows were loaded from a file, and how quickly"""
+    duration = time.time() - summary['started']
+    print("{:<60} {:>10} rows {:>10} new {:>10,.0f} rows/sec{}".format(
+        os.path.basename(file_name),
+        summary['rows'],
+        new_rows,
+        summary['rows'] / max(duration, 1e-6),
+        "" if summary['error'] is None else "  (stopped early: {})".format(summary['error'])))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,84 @@
+## These are some tests for distinctive_words.py
+## They can be run with pytest with the command `py.test test_distinctive_words.py`
+
+import distinctive_words as dw
+import multiprocessing
+
+## Tests of Scoring Functions
+def test_posterior_probs_matrix_matches_freq():
+    count_dicts = [
+        {u'debate': 9, u'tax': 5, u'wall': 5, u'gun': 5, u'rain': 1}, # tied counts
+        {u'debate': 3, u'tax': 5, u'emails': 7, u'bern': 2},
+        {}] # a stream without any tokens
+    all_streams_count_dict = reduce(
+        lambda x, y: dw.tz.merge_with(sum, x, y), count_dicts)
+    vocabulary, count_matrix, stream_totals = dw.build_count_matrix(count_dicts)
+    for num_words in [1, 2, 3, 10]:
+        for stream_num, count_dict in enumerate(count_dicts):
+            assert dw.get_posterior_probs_matrix(
+                num_words, vocabulary, count_matrix, stream_totals, stream_num) == (
+                dw.get_posterior_probs_freq(num_words, all_streams_count_dict, count_dict))
+    assert [x['token'] for x in dw.get_posterior_probs_matrix(
+        3, vocabulary, count_matrix, stream_totals, 0)] == [u'gun', u'debate', u'tax']
+    assert dw.get_posterior_probs_matrix(10, vocabulary, count_matrix, stream_totals, 2) == []
+
+## Tests of Sketch Functions
+def make_chunk_counts():
+    """Return the token counts of several chunks, with a few frequent tokens
+    and many rare ones"""
+    return [
+        dw.tz.merge(
+            {u'frequent{}'.format(x): (10 - x) * 20 + chunk_num for x in range(10)},
+            {u'rare{}'.format(x): 1 + x % 3 for x in range(chunk_num * 200, chunk_num * 200 + 300)})
+        for chunk_num in range(5)]
+
+def test_sketch_within_error_bound():
+    chunk_counts = make_chunk_counts()
+    exact_counts = dw.tz.merge_with(sum, chunk_counts)
+    sketch = reduce(dw.add_to_sketch, chunk_counts, dw.new_sketch(0.01, 0.01, 20))
+    assert sketch['total'] == sum(exact_counts.values())
+    tokens = sorted(exact_counts)
+    errors = dw.estimate_counts(sketch, tokens) - [exact_counts[x] for x in tokens]
+    assert errors.min() >= 0 # never under-counts
+    assert errors.max() <= 0.01 * sketch['total']
+    assert dw.estimate_counts(sketch, [u'never_seen'])[0] <= 0.01 * sketch['total']
+
+def test_merged_heavy_hitters_match_single_pass():
+    chunk_counts = make_chunk_counts()
+    exact_counts = dw.tz.merge_with(sum, chunk_counts)
+    merged = reduce(dw.add_to_sketch, chunk_counts, dw.new_sketch(0.01, 0.01, 20))
+    single_pass = dw.add_to_sketch(dw.new_sketch(0.01, 0.01, 20), exact_counts)
+    top_tokens = lambda heavy_hitters: sorted(heavy_hitters, key=lambda x: -heavy_hitters[x])[:10]
+    assert top_tokens(merged['heavy_hitters']) == top_tokens(single_pass['heavy_hitters'])
+    assert top_tokens(merged['heavy_hitters']) == [u'frequent{}'.format(x) for x in range(10)]
+    assert all( # the summary's counts are never too low either
+        count >= exact_counts[token] for token, count in merged['heavy_hitters'].items())
+
+## Tests of Parsing Functions
+def test_strip_html():
+    assert dw.strip_html(u'<a title="1>2" href=\'/x\'>Link</a> &amp; text') == u'Link & text'
+    assert dw.strip_html(u'a<script type="text/javascript">var b = "<b>";</script>b') == u'ab'
+    assert dw.strip_html(u'<STYLE>p {color: red}</style>c<![CDATA[ x < y ]]>d<!-- e -->') == u'cd'
+    assert dw.strip_html(u'1 < 2 and 3 > 2') == u'1 < 2 and 3 > 2'
+
+def test_parse_with_pool_matches_serial():
+    allowed_parts_of_speech = ['NN', 'NNS', 'JJ', 'VB']
+    documents = [
+        u"<p>The candidates argued about taxes and the economy at the debate.</p>",
+        u"Voters watched the debate http://example.com/live and talked about guns.",
+        u"Ceci n'est pas une phrase en anglais, donc elle est ignor\xe9e.",
+        None] * 30
+    serial_count = dw.parse_content_into_count(allowed_parts_of_speech, None, documents)
+    serial_counts = dw.parse_content_into_counts(allowed_parts_of_speech, None, documents)
+    pool = multiprocessing.Pool(2, initializer=dw.load_nlp_models)
+    try:
+        assert dw.parse_content_into_count(allowed_parts_of_speech, pool, documents) == serial_count
+        assert dw.parse_content_into_counts(allowed_parts_of_speech, pool, documents) == serial_counts
+    finally:
+        pool.terminate()
+    assert u'debate' in serial_count
+
+def test_parse_empty_window():
+    assert dw.parse_content_into_count('all', None, []) == {}
+    vocabulary, count_matrix, stream_totals = dw.build_count_matrix([{}, {}])
+    assert vocabulary == [] and list(stream_totals) == [0, 0]
@@ -0,0 +1,66 @@
+## These are some tests for load_to_db.py
+## They can be run with pytest with the command `py.test test_load_to_db.py`
+
+import load_to_db as ltd
+import gzip
+import sqlite3
+import cStringIO
+
+## Helper Functions
+def make_member(text):
+    """Return the text as a gzip member, as the consumers write each chunk"""
+    buffer = cStringIO.StringIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb") as member:
+        member.write(text)
+    return buffer.getvalue()
+
+def make_rows(ids):
+    """Return the CSV of comments with the given ids"""
+    return "".join(
+        "comment,2015-10-13T09:0{}:00Z,comment,u,{},hi\n".format(x % 10, x) for x in ids)
+
+HEADER = make_member("verb,published,objectType,url,id,content\n")
+
+def load(tmpdir, file_name):
+    """Load the file into the test database, returning the number of new rows"""
+    return ltd.load_files([str(file_name)], str(tmpdir.join("test.sqlite")), 1, 7, 100)
+
+def count_rows(tmpdir, table_name):
+    """Return the number of rows in the table, of distinct ids, and the sum
+    of its per-minute counts"""
+    connection = sqlite3.connect(str(tmpdir.join("test.sqlite")))
+    try:
+        return connection.execute(
+            "SELECT (SELECT count(*) FROM {0}), (SELECT count(DISTINCT id) FROM {0}), "
+            "(SELECT sum(num_entries) FROM {0}_per_minute)".format(table_name)).fetchone()
+    finally:
+        connection.close()
+
+## Tests of Loading Functions
+def test_resume_from_offset(tmpdir):
+    file_name = tmpdir.join("comments_stream_2015-10-13_09-03-40.csv.gz")
+    file_name.write(HEADER + make_member(make_rows(range(0, 20))), 'wb')
+    assert load(tmpdir, file_name) == 20
+    file_name.write(make_member(make_rows(range(20, 35))), 'ab') # the consumer adds a chunk
+    assert load(tmpdir, file_name) == 15
+    assert load(tmpdir, file_name) == 0 # nothing new
+    assert count_rows(tmpdir, "comments") == (35, 35, 35)
+
+def test_partial_member(tmpdir):
+    file_name = tmpdir.join("comments_unmatched_stream_2015-10-13_09-03-40.csv.gz")
+    last_member = make_member(make_rows(range(20, 2020)))
+    file_name.write(HEADER + make_member(make_rows(range(0, 20))), 'wb')
+    file_name.write(last_member[:len(last_member) // 2], 'ab') # still being written
+    assert load(tmpdir, file_name) == 20
+    file_name.write(last_member[len(last_member) // 2:], 'ab') # the chunk is finished
+    assert load(tmpdir, file_name) == 2000
+    assert load(tmpdir, file_name) == 0
+    assert count_rows(tmpdir, "comments_unmatched") == (2020, 2020, 2020)
+
+def test_get_stream_name():
+    assert ltd.get_stream_name("filtered_tweets") == "filtered_tweets"
+    assert ltd.get_stream_name("tweets_unmatched") == "tweets"
+    assert ltd.get_stream_name("posts_debate") == "posts"
+    assert ltd.get_stream_name("loaded_files") is None
+    assert ltd.get_column_type("comments", "actor_id") == 'TEXT'
+    assert ltd.get_column_type("likes_unmatched", "actor_id") == 'INTEGER'
@@ -0,0 +1,109 @@
+## Some simple benchmarks of the consumers' parsing stages
+## They can be run from this folder with `python benchmark_consumers.py`
+## and use the example events in the test_data folder.
+
+import consumer_functions as cf
+import cytoolz.curried as tz # functional programming library
+import json                  # for parsing JSON
+import time                  # for timing the benchmarks
+
+NUM_LINES = 100000 # number of lines to run through each stage
+KEEP_ALIVE_RATE = 10 # one in this many lines is an empty keep-alive line
+
+## Main Functions
+def main():
+    """Run each of the benchmarks and print the results"""
+    benchmark_json_decoding(load_example_lines(NUM_LINES))
+    benchmark_parsing(NUM_LINES)
+
+def benchmark_json_decoding(lines):
+    """Compare lines/sec of the original json.loads path to each of the
+    available decoders, with keep-alive lines skipped before decoding"""
+    def original_json_load(given_item):
+        """permissive_json_load, as it was before the pluggable decoder"""
+        try:
+            return json.loads(given_item)
+        except:
+            return {}
+    print("JSON decoding, {} lines".format(len(lines)))
+    print_rate("json.loads, every line", measure_rate(
+        lambda x: tz.pipe(x, tz.map(original_json_load), tz.count), lines))
+    for decoder_name in ['json', 'ujson', 'orjson', 'simdjson']:
+        decoder = cf.get_json_decoder(decoder_name)
+        if decoder_name != 'json' and decoder is json.loads:
+            print_rate(decoder_name, None) # not installed
+            continue
+        cf.JSON_LOADS = decoder
+        print_rate("{}, skipping keep-alives".format(decoder_name), measure_rate(
+            lambda x: tz.pipe(
+                x,
+                tz.remove(cf.is_keep_alive),
+                tz.map(cf.permissive_json_load),
+                tz.count),
+            lines))
+
+def benchmark_parsing(num_events):
+    """Compare events/sec of the original parse functions to the compiled
+    field plans, for each stream"""
+    @tz.curry
+    def original_parse(field_plan, given_dict):
+        """A parse function, as it was before the compiled field plans: 
+        each field looked up with get_value_if_present_nested, and tweet 
+        timestamps reformatted without the cache"""
+        gv = cf.get_value_if_present_nested(given_dict)
+        return {
+            column: (cf.convert_timestamp if transform is cf.reformat_timestamp
+                     else transform or tz.identity)(gv(path))
+            for column, path, transform, _ in field_plan}
+    parse_functions = [
+        ('tweets', cf.TWEET_FIELDS, cf.parse_tweet),
+        ('posts', cf.POST_FIELDS, cf.parse_post),
+        ('comments', cf.COMMENT_FIELDS, cf.parse_comment),
+        ('likes', cf.LIKE_FIELDS, cf.parse_like)]
+    print("Parsing, {} events".format(num_events))
+    for stream_name, field_plan, parse_function in parse_functions:
+        events = [load_example_event(stream_name)] * num_events
+        print_rate("parse {}, original".format(stream_name), measure_rate(
+            lambda x: tz.pipe(x, tz.map(original_parse(field_plan)), tz.count), events))
+        print_rate("parse {}".format(stream_name), measure_rate(
+            lambda x: tz.pipe(x, tz.map(parse_function), tz.count), events))
+
+## Helper Functions
+def load_example_event(stream_name):
+    """Return the decoded example event for the given stream"""
+    file_names = {'tweets': "test_data/example_twitter.json"}
+    file_name = file_names.get(stream_name, "test_data/example_{}.json".format(stream_name))
+    with open(file_name) as f:
+        return json.load(f)
+
+def load_example_lines(num_lines):
+    """Return num_lines lines, as they would arrive from the WordPress
+    streams, built by repeating the example events"""
+    examples = tz.pipe(
+        ['posts', 'comments', 'likes'],
+        tz.map(lambda x: "test_data/example_{}.json".format(x)),
+        tz.map(lambda x: json.dumps(json.load(open(x)))), # one line each
+        list)
+    return [
+        '' if num % KEEP_ALIVE_RATE == 0 else examples[num % len(examples)]
+        for num in range(num_lines)]
+
+def measure_rate(func, items, repeat=3):
+    """Return the best items/second from repeat runs of func over items"""
+    best_time = None
+    for _ in range(repeat):
+        start_time = time.time()
+        func(items)
+        duration = time.time() - start_time
+        best_time = duration if best_time is None else min(best_time, duration)
+    return len(items) / best_time
+
+def print_rate(label, rate):
+    """Print a line of benchmark results"""
+    if rate is None:
+        print("    {:<40} not installed".format(label))
+    else:
+        print("    {:<40} {:>12,.0f} per second".format(label, rate))
+
+if __name__ == '__main__':
+    main()
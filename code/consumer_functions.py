@@ -3,9 +3,6 @@ import requests              # for working with HTTP
 import cytoolz.curried as tz # functional programming library
 import os                    # for using environment variables
 import twitter               # for connecting to twitter API, python twitter tools
-import numpy as np           # for matrix math
-import pandas as pd          # for data wrangling
-import sqlalchemy as sqlal   # for connecting to databases
 import unicodecsv as csv     # for saving to CSV in utf-8 by default
 import gzip                  # for compression of CSV output
 import time                  # for simple benchmarks
@@ -13,29 +10,88 @@ import datetime as dt        # for converting the formats of timestamps
 import pdb                   # for testing
 import argparse              # for accepting command line arguments
 import yaml                  # for loading the configuration file
-# import sqlite3               # for interacting with SQLite databases
+import threading             # for consuming several streams in one process
+import Queue                 # for passing lines between threads
+import random                # for jittering the reconnection delays
+import importlib             # for loading the configured JSON decoder
+import signal                # for saving in-memory data on a SIGTERM
+import cStringIO             # for building each chunk of CSV in memory
+import sqlite3               # for saving to SQLite databases
+try:
+    import pyarrow as pa         # for saving to Parquet (optional)
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
 ## Accept Arguments
 parser = argparse.ArgumentParser(description="Save a WordPress or Twitter stream")
 parser.add_argument('stream_key', metavar='stream_key', type=str, nargs=1, 
-                    help='Which stream to consume (tweets, likes, posts, or comments)')
-STREAM_KEY = tz.get_in([0], parser.parse_args().stream_key, default=None)
+                    help='Which stream to consume (tweets, likes, posts, comments, or all)')
 
 ## Load Configuration
 with open('config.yaml') as config_file:
     CONFIG = yaml.load(config_file.read())
 TWITTER_CREDENTIALS = {
-    "access_token": os.environ['TWITTER_ACCESS_TOKEN'],
-    "access_token_secret": os.environ['TWITTER_ACCESS_SECRET'],
-    "consumer_key": os.environ['TWITTER_CONSUMER_KEY'],
-    "consumer_secret": os.environ['TWITTER_CONSUMER_SECRET']
+    "access_token": os.environ.get('TWITTER_ACCESS_TOKEN'),
+    "access_token_secret": os.environ.get('TWITTER_ACCESS_SECRET'),
+    "consumer_key": os.environ.get('TWITTER_CONSUMER_KEY'),
+    "consumer_secret": os.environ.get('TWITTER_CONSUMER_SECRET')
 }
 
+STOP_EVENT = threading.Event() # set to ask every running stream to save and stop
+STOP_CHECK_INTERVAL = 1        # longest a quiet stream waits before checking STOP_EVENT (seconds)
+END_OF_STREAM = object()       # placed on a queue when its stream has ended
+
 ## Primary Functions
 def main():
     """Overall function to start it off"""
-    print("Starting a stream consumer for {}".format(STREAM_KEY))
-    connect_to_stream(STREAM_KEY)
+    stream_key = tz.get_in([0], parser.parse_args().stream_key, default=None)
+    signal.signal(signal.SIGTERM, raise_keyboard_interrupt) # treat it like a SIGINT
+    if stream_key == "all":
+        print("Starting stream consumers for {}".format(", ".join(CONFIG['all_streams'])))
+        connect_to_all_streams(CONFIG['all_streams'])
+    else:
+        print("Starting a stream consumer for {}".format(stream_key))
+        connect_to_stream(stream_key)
+
+def raise_keyboard_interrupt(signal_number, frame):
+    """Signal handler, so the same in-memory data saving that happens on
+    a SIGINT also happens for other signals"""
+    raise KeyboardInterrupt()
+
+def connect_to_all_streams(stream_keys):
+    """Consume several streams from a single process, each in its own thread
+
+    Every stream keeps its own pipeline and saving function, so a slow 
+    writer only holds back its own stream, and an error in one stream is 
+    logged without stopping the others."""
+    threads = tz.pipe(
+        stream_keys,
+        tz.map(lambda x: threading.Thread(
+            target=connect_to_stream_safely, args=(x,), name=x)),
+        list)
+    for thread in threads:
+        thread.daemon = True # a stalled connection shouldn't keep the process alive
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1) # rather than join(), which would not see a SIGINT
+    except KeyboardInterrupt:
+        # Ask each stream to save its in-memory data, then give them a moment
+        STOP_EVENT.set()
+        for thread in threads:
+            thread.join(CONFIG['shutdown_timeout'])
+    return True
+
+def connect_to_stream_safely(stream_key):
+    """Run connect_to_stream, logging instead of raising any errors"""
+    try:
+        connect_to_stream(stream_key)
+    except Exception as e:
+        message = "{} stopped with an error: {!r}".format(stream_key, e)
+        write_to_log(stream_key, message + "\n")
+        print(message)
+    return True
 
 def connect_to_stream(stream_key):
     """Connect to the appropriate stream"""
@@ -43,6 +99,8 @@ def connect_to_stream(stream_key):
     # Set save function
     if CONFIG['endpoint'] == 'sqlite':
         saveing_function = save_sqlite
+    elif CONFIG['endpoint'] == 'parquet':
+        saveing_function = save_parquet
     else:
         saveing_function = save_csv_gz
 
@@ -63,10 +121,18 @@ def connect_to_wordpress_stream(stream_key, saveing_function):
         'comments': parse_comment}
     stream = tz.pipe(
         ## Connect
-        start_wordpress_stream(CONFIG['stream_urls'][stream_key]),
+        start_buffered_wordpress_stream(stream_key, CONFIG['stream_urls'][stream_key]),
+        until_stopped,
         ## Parse
+        tz.remove(is_keep_alive), # skip the empty lines that keep the connection open
         tz.map(permissive_json_load), # parse the JSON, or return an empty dictionary
         tz.map(parse_functions[stream_key]), # parse into a flat dictionary
+        ## Tag
+        tag_topics(stream_key), # add a topic column, if topic_tagging is set up
+        ## Count
+        count_per_minute(stream_key), # keep the per-minute counts up to date
+        ## Route
+        handle_unmatched(stream_key), # keep, drop or separate events without a topic
     )
 
     # Collect
@@ -76,13 +142,20 @@ def connect_to_twitter_stream(stream_key, saveing_function):
     """Connect to & consume a Twitter stream"""
     stream = tz.pipe(
         ## Connect
-        start_stream_twitter(), # public sampled stream
-        tz.map(print_twitter_stall_warning),
+        reconnecting_stream(stream_key, start_stream_twitter), # public sampled stream
+        until_stopped,
+        tz.map(print_twitter_stall_warning(stream_key)),
         ## Filter
         tz.filter(is_tweet), # filter to tweets
         # tz.filter(is_user_lang_tweet(["en", "en-AU", "en-au", "en-GB", "en-gb"])), # filter to English
         ## Parse
         tz.map(parse_tweet), # parse into a flat dictionary
+        ## Tag
+        tag_topics(stream_key), # add a topic column, if topic_tagging is set up
+        ## Count
+        count_per_minute(stream_key), # keep the per-minute counts up to date
+        ## Route
+        handle_unmatched(stream_key), # keep, drop or separate events without a topic
     )
 
     # Collect
@@ -93,12 +166,21 @@ def connect_to_twitter_filtered_stream(stream_key, saveing_function):
     some of the filtering"""
     stream = tz.pipe(
         ## Connect
-        start_stream_twitter(**CONFIG['twitter_filter']),
-        tz.map(print_twitter_stall_warning),
+        reconnecting_stream(
+            stream_key, 
+            lambda: start_stream_twitter(**CONFIG['twitter_filter'])),
+        until_stopped,
+        tz.map(print_twitter_stall_warning(stream_key)),
         ## Filter
         tz.filter(is_tweet), # filter to tweets
         ## Parse
         tz.map(parse_tweet), # parse into a flat dictionary
+        ## Tag
+        tag_topics(stream_key), # add a topic column, if topic_tagging is set up
+        ## Count
+        count_per_minute(stream_key), # keep the per-minute counts up to date
+        ## Route
+        handle_unmatched(stream_key), # keep, drop or separate events without a topic
     )
 
     ## Collect
@@ -129,16 +211,145 @@ def start_stream_twitter(**kargs):
         token=TWITTER_CREDENTIALS['access_token'],
         token_secret=TWITTER_CREDENTIALS['access_token_secret']
     )
-    twitter_public_stream = twitter.TwitterStream(auth=auth)
+    twitter_public_stream = twitter.TwitterStream( # yields {'timeout': True} when quiet
+        auth=auth, timeout=STOP_CHECK_INTERVAL)
     if len(kargs) > 0:
         return twitter_public_stream.statuses.filter(**kargs)
     else: 
         return twitter_public_stream.statuses.sample()
 
-def start_wordpress_stream(stream_url):
+def start_wordpress_stream(stream_url, chunk_size=512):
     """Return an iterator for any of the WordPress streams"""
-    r = requests.get(stream_url, stream=True)
-    return r.iter_lines()
+    r = requests.get(
+        stream_url, 
+        stream=True, 
+        timeout=CONFIG['reconnect']['read_timeout']) # so a stalled connection raises
+    return r.iter_lines(chunk_size=chunk_size)
+
+def start_buffered_wordpress_stream(stream_key, stream_url):
+    """Return an iterator for any of the WordPress streams, where the 
+    network is read on a separate thread
+
+    The reading thread only moves lines into a bounded queue, so it can keep
+    up with the socket while the lines are parsed and saved. If the queue 
+    fills up, new lines are dropped (and counted) rather than letting the 
+    TCP buffer fill."""
+    buffer_config = CONFIG['stream_buffer']
+    line_queue = Queue.Queue(maxsize=buffer_config['queue_size'])
+    stats = {'max_queue_depth': 0, 'dropped_lines': 0}
+    connect = lambda: start_wordpress_stream(stream_url, buffer_config['read_chunk_size'])
+    reader = threading.Thread(
+        target=read_into_queue,
+        args=(lambda: reconnecting_stream(stream_key, connect), line_queue, stats),
+        name="{}_reader".format(stream_key))
+    reader.daemon = True
+    reader.start()
+    return iterate_queue(stream_key, line_queue, stats)
+
+def read_into_queue(connect_function, line_queue, stats):
+    """Move the lines from a stream into the given queue, counting any 
+    lines that are dropped because the queue is full"""
+    try:
+        for line in connect_function():
+            try:
+                line_queue.put_nowait(line)
+            except Queue.Full:
+                stats['dropped_lines'] += 1
+            stats['max_queue_depth'] = max(stats['max_queue_depth'], line_queue.qsize())
+    finally:
+        while True: # let the reading side know it has ended, unless it has stopped
+            try:
+                line_queue.put(END_OF_STREAM, timeout=STOP_CHECK_INTERVAL)
+                break
+            except Queue.Full:
+                if STOP_EVENT.is_set():
+                    break
+
+def iterate_queue(stream_key, line_queue, stats):
+    """Yield the lines from the given queue until the stream ends or 
+    STOP_EVENT is set, occasionally logging how full the queue is
+
+    The queue is read with a timeout, since on Python 2 a blocking get() 
+    can't be interrupted (by a SIGINT or STOP_EVENT) while the stream is 
+    quiet."""
+    log_interval = CONFIG['stream_buffer']['log_interval']
+    last_log = time.time()
+    while True:
+        try:
+            line = line_queue.get(timeout=STOP_CHECK_INTERVAL)
+        except Queue.Empty:
+            if STOP_EVENT.is_set():
+                break
+            continue
+        if line is END_OF_STREAM:
+            break
+        yield line
+        if time.time() - last_log > log_interval:
+            log_buffer_stats(stream_key, line_queue.qsize(), stats)
+            stats['max_queue_depth'] = 0 # report the max since the last update
+            last_log = time.time()
+
+def reconnecting_stream(stream_key, connect_function):
+    """Yield the items from connect_function(), reconnecting whenever the 
+    connection ends or fails
+
+    Reconnection attempts are spaced out with a jittered exponential backoff.
+    Since this is a single iterator, whatever is saving the stream keeps the 
+    same output open across reconnections. Each gap in the stream is recorded
+    with record_gap, which only ends once a real event arrives (the keep-alives
+    and markers a stalled connection may still send don't count)."""
+    reconnect_config = CONFIG['reconnect']
+    attempt = 0          # reconnection attempts since the last event
+    gap_start = None     # when the present gap started, if in one
+    num_events = 0       # events seen so far, for estimating the number lost
+    connected_time = 0.0 # seconds spent connected so far
+    while not STOP_EVENT.is_set():
+        connected_at = time.time()
+        try:
+            for item in connect_function():
+                if not is_stream_marker(item): # only a real event ends a gap
+                    if gap_start is not None:
+                        record_gap(stream_key, gap_start, time.time(), 
+                                   num_events / max(connected_time, 1.0))
+                        gap_start = None
+                        attempt = 0
+                    num_events += 1
+                yield item
+            reason = "connection ended"
+        except Exception as e:
+            reason = "connection failed: {!r}".format(e)
+        if gap_start is None:
+            gap_start = time.time()
+            connected_time += gap_start - connected_at
+        delay = backoff_delay(
+            attempt, reconnect_config['initial_delay'], reconnect_config['max_delay'])
+        attempt += 1
+        write_to_log(stream_key, "{} {}, reconnecting in {:.1f} seconds\n".format(
+            dt.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"), reason, delay))
+        STOP_EVENT.wait(delay)
+    if gap_start is not None: # record a gap that lasted until it was stopped
+        record_gap(stream_key, gap_start, time.time(), 
+                   num_events / max(connected_time, 1.0))
+
+def backoff_delay(attempt, initial_delay, max_delay):
+    """Return how many seconds to wait before the given reconnection attempt
+
+    The delay doubles with each attempt (up to max_delay), and is jittered 
+    so that several streams don't all reconnect at the same moment."""
+    delay = min(max_delay, initial_delay * 2 ** attempt)
+    return random.uniform(delay / 2.0, delay)
+
+def until_stopped(stream_iterator):
+    """Pass items through until STOP_EVENT is set, then end the stream
+
+    STOP_EVENT is checked as each item arrives, so the streams given to this
+    yield something at least every STOP_CHECK_INTERVAL seconds, even when 
+    they are quiet: the Twitter streams yield {'timeout': True} markers (which
+    is_tweet filters out), and iterate_queue checks STOP_EVENT while waiting."""
+    for item in stream_iterator:
+        yield item
+        if STOP_EVENT.is_set():
+            break
 
 ## Filter Functions
 def is_tweet(given_item):
@@ -151,11 +362,27 @@ def is_tweet(given_item):
             'user_withheld', 
             'disconnect', 
             'warning', 
-            'event']):
+            'event',
+            'hangup', # python twitter tools' note that the connection ended
+            'timeout']): # and its marker that nothing arrived for a while
         return True
     else:
         return False
 
+def is_keep_alive(given_line):
+    """Predicate to check whether a line from a WordPress stream is one of
+    the empty lines sent to keep the connection open"""
+    return given_line.strip() == ''
+
+def is_stream_marker(given_item):
+    """Predicate to check whether an item only tells about the connection
+    rather than being an event: a WordPress keep-alive line, or one of python
+    twitter tools' hangup or timeout markers"""
+    if isinstance(given_item, dict):
+        return not set(given_item.keys()).isdisjoint(['hangup', 'timeout', 'heartbeat_timeout'])
+    else:
+        return is_keep_alive(given_item)
+
 @tz.curry
 def is_user_lang_tweet(allow_lang_list, given_item):
     """Predicate to check whether the user_lang of the given item is in the 
@@ -164,113 +391,407 @@ def is_user_lang_tweet(allow_lang_list, given_item):
     return user_lang in allow_lang_list
 
 ## Parsing Functions
-def parse_tweet(given_dict):
-    """Reorganize the resulting dictionary"""
-    def get_hashtag_string(given_item):
-        """Return a string of hashtags associated with the given item"""
-        return tz.pipe(
-            tz.get_in(['entities', 'hashtags'], given_item, default=[]),
-            tz.map(lambda x: tz.get_in(['text'], x, default=None)),
-            tz.filter(lambda x: x is not None),
-            lambda x: ", ".join(x))
-    def reformat_timestamp(given_ts):
-        """Reformat into WordPress.com format"""
-        # Twitter example: "Sat Oct 10 14:48:34 +0000 2015"
-        # WordPress example: "2015-10-10T19:42:34Z"
-        if given_ts is None:
-            return ""
-        try: 
-            return tz.pipe(
-                given_ts,
-                lambda x: dt.datetime.strptime(x, "%a %b %d %H:%M:%S +0000 %Y"),
-                lambda x: x.strftime("%Y-%m-%dT%H:%M:%SZ"))
-        except: # If it can't reformat it, just use the previous version
-            return str(given_ts)
-    gv = get_value_if_present_nested(given_dict)
-    return {
-        'timestamp_ms': gv(['timestamp_ms']),
-        'created_at': reformat_timestamp(gv(['created_at'])),
-        'text': gv(['text']),
-        'hashtags': get_hashtag_string(given_dict),
-        'is_quote_status': gv(['is_quote_status']),
-        'user_id': gv(['user','id']),
-        'user_scree_name': gv(['user','screen_name']),
-        'user_lang': gv(['user','lang']),
-        'user_favourites': gv(['user','favourites_count']),
-        'count_urls': len_or_none(gv(['entities','urls'])),
-        'count_media': len_or_none(gv(['entities','media'])),
-        'is_reply': gv(['in_reply_to_user_id']) is not None,
-        'is_retweet': gv(['retweeted_status']) is not None, 
-        'time_zone': gv(['user', 'time_zone'])}
-
-def parse_post(given_dict):
-    """Return parsed subset of a post object"""
-    def get_tags(given_dict):
-        """Return a string of the tags associated with a post"""
-        return tz.pipe(
-            tz.get_in(['object', 'tags'], given_dict, default = []),
-            tz.filter(lambda x: tz.get_in(['objectType'], x, default=None) == 'tag'),
-            tz.map(lambda x: tz.get_in(['displayName'], x, default=None)),
-            lambda x: ", ".join(x)
-        )
-    def get_categories(given_dict):
-        """Return a string of the categories associated with a post"""
+# Each stream is parsed according to a field plan, a list of 
+# (column, key path, transform, column type) entries. The column is set to 
+# the value at the key path in the event (or None if it isn't present), 
+# passed through the transform if there is one. compile_field_plan turns a 
+# plan into the parse function, once, when this module is loaded. The column
+# types ('string', 'int64', or 'bool') are used by the typed outputs.
+def compile_field_plan(field_plan):
+    """Return a function that parses an event into a flat dictionary, 
+    according to the given field plan"""
+    plain_fields = [
+        (column, compile_key_path(key_list))
+        for column, key_list, transform, _ in field_plan 
+        if transform is None]
+    transformed_fields = [
+        (column, compile_key_path(key_list), transform)
+        for column, key_list, transform, _ in field_plan 
+        if transform is not None]
+    def parse_event(given_dict):
+        parsed = {column: get_value(given_dict) for column, get_value in plain_fields}
+        for column, get_value, transform in transformed_fields:
+            parsed[column] = transform(get_value(given_dict))
+        return parsed
+    return parse_event
+
+def compile_key_path(key_list):
+    """Return a function that gets the value at key_list in a nested 
+    dictionary, or None (the same as get_value_if_present_nested)"""
+    if len(key_list) == 1:
+        key = key_list[0]
+        def get_value(given_dict):
+            if isinstance(given_dict, dict):
+                return given_dict.get(key)
+            return None
+    elif len(key_list) == 2:
+        outer_key, inner_key = key_list
+        def get_value(given_dict):
+            if isinstance(given_dict, dict):
+                inner_dict = given_dict.get(outer_key)
+                if isinstance(inner_dict, dict):
+                    return inner_dict.get(inner_key)
+            return None
+    else:
+        def get_value(given_dict):
+            for key in key_list:
+                if not isinstance(given_dict, dict):
+                    return None
+                given_dict = given_dict.get(key)
+            return given_dict
+    return get_value
+
+## Field Transforms
+def len_or_none(given_item):
+    """If it has one, return length, otherwise return None"""
+    try: 
+        return len(given_item)
+    except:
+        return None
+
+def is_not_none(given_item):
+    """Predicate to check whether the given item is present"""
+    return given_item is not None
+
+def reformat_timestamp(given_ts):
+    """Reformat a Twitter timestamp into WordPress.com format, caching 
+    the results
+
+    Tweets arrive in nearly the order they were created, so many tweets in a
+    row share the same timestamp. Rather than tracking which entry was used 
+    least recently, the cache is simply emptied when it fills up."""
+    try:
+        return TIMESTAMP_CACHE[given_ts]
+    except KeyError:
+        if len(TIMESTAMP_CACHE) >= TIMESTAMP_CACHE_SIZE:
+            TIMESTAMP_CACHE.clear()
+        reformatted = convert_timestamp(given_ts)
+        TIMESTAMP_CACHE[given_ts] = reformatted
+        return reformatted
+    except TypeError: # it can't be cached if it isn't hashable
+        return convert_timestamp(given_ts)
+
+TIMESTAMP_CACHE = {}
+TIMESTAMP_CACHE_SIZE = 1024
+
+def convert_timestamp(given_ts):
+    """Convert a Twitter timestamp into WordPress.com format"""
+    # Twitter example: "Sat Oct 10 14:48:34 +0000 2015"
+    # WordPress example: "2015-10-10T19:42:34Z"
+    if given_ts is None:
+        return ""
+    try: 
         return tz.pipe(
-            tz.get_in(['object', 'tags'], given_dict, default = []),
-            tz.filter(lambda x: tz.get_in(['objectType'], x, default=None) == 'category'),
-            tz.map(lambda x: tz.get_in(['displayName'], x, default=None)),
-            lambda x: ", ".join(x)
-        )
-    gv = get_value_if_present_nested(given_dict)
-    return {
-        'verb': gv(['verb']),
-        'published': gv(['object', 'published']), # date-time stamp
-        'objectType': gv(['object', 'objectType']),
-        'displayName': gv(['displayName']), # title
-        'permalinkUrl': gv(['object', 'permalinkUrl']),
-        'summary': gv(['object', 'summary']),
-        'content': gv(['object', 'content']), # includes some HTML markup
-        'content_len': len_or_none(gv(['object', 'content'])), # presently includes the HTML markup
-        'tags': get_tags(given_dict),
-        'categories': get_categories(given_dict),
-        'actor_name': gv(['actor', 'displayName']),
-        'actor_id': gv(['actor', 'id']),
-        'actor_type': gv(['actor', 'objectType'])}
-
-def parse_comment(given_dict):
-    """Return a somewhat parsed subset of a comment object"""
-    gv = get_value_if_present_nested(given_dict)
-    return {
-        'verb': gv(['verb']),
-        'published': gv(['published']), # a date-time stamp
-        'objectType': gv(['object', 'objectType']),
-        'url': gv(['object', 'url']),
-        'id': gv(['object', 'id']),
-        'content': gv(['content']),
-        'content_len': len_or_none(gv(['content'])),
-        'target_lang': gv(['target', 'lang']),
-        'target_summary': gv(['target', 'summary']),
-        'target_wpCommentCount': gv(['target', 'wpCommentCount']),
-        'actor_name': gv(['actor', 'displayName']),
-        'actor_id': gv(['actor', 'id']),
-        'actor_type': gv(['actor', 'objectType']),
-    }
-
-def parse_like(given_dict):
-    """Return a somewhat parsed subset of a like object"""
-    gv = get_value_if_present_nested(given_dict)
-    return {
-        'verb': gv(['verb']),
-        'published': gv(['published']),
-        'objectType': gv(['object', 'objectType']),
-        'url': gv(['object', 'url']),
-        'displayName': gv(['object', 'displayName']),
-        'target_name': gv(['target', 'displayName']),
-        'target_objectType': gv(['target', 'objectType']),
-        'actor_name': gv(['actor', 'displayName']),
-        'actor_id': gv(['actor', 'wpcom:user_id']),
-        'actor_type': gv(['actor', 'objectType']),
-    }
+            given_ts,
+            lambda x: dt.datetime.strptime(x, "%a %b %d %H:%M:%S +0000 %Y"),
+            lambda x: x.strftime("%Y-%m-%dT%H:%M:%SZ"))
+    except: # If it can't reformat it, just use the previous version
+        return str(given_ts)
+
+def int_or_none(given_item):
+    """Return the given item as an integer, or None if it can't be converted"""
+    try:
+        return int(given_item)
+    except (TypeError, ValueError):
+        return None
+
+def unicode_or_none(given_item):
+    """Return the given item as a unicode string, or None"""
+    if given_item is None or isinstance(given_item, unicode):
+        return given_item
+    elif isinstance(given_item, str):
+        return given_item.decode('utf-8', 'replace')
+    else:
+        return unicode(given_item)
+
+def bool_or_none(given_item):
+    """Return the given item as a boolean, or None"""
+    if given_item is None:
+        return None
+    return bool(given_item)
+
+def join_hashtags(hashtags):
+    """Return a string of the given list of hashtag entities"""
+    if not isinstance(hashtags, list):
+        return ""
+    return ", ".join(
+        x['text'] for x in hashtags 
+        if isinstance(x, dict) and x.get('text') is not None)
+
+@tz.curry
+def join_tags(object_type, tags):
+    """Return a string of the names of the given list of post tags, 
+    limited to those of the given object_type (either tag or category)"""
+    if not isinstance(tags, list):
+        return ""
+    return ", ".join(
+        x['displayName'] for x in tags
+        if isinstance(x, dict) and x.get('objectType') == object_type 
+            and x.get('displayName') is not None)
+
+## Field Plans
+TWEET_FIELDS = [
+    ('timestamp_ms', ['timestamp_ms'], None, 'string'),
+    ('created_at', ['created_at'], reformat_timestamp, 'string'),
+    ('text', ['text'], None, 'string'),
+    ('hashtags', ['entities', 'hashtags'], join_hashtags, 'string'),
+    ('is_quote_status', ['is_quote_status'], None, 'bool'),
+    ('user_id', ['user', 'id'], None, 'int64'),
+    ('user_scree_name', ['user', 'screen_name'], None, 'string'),
+    ('user_lang', ['user', 'lang'], None, 'string'),
+    ('user_favourites', ['user', 'favourites_count'], None, 'int64'),
+    ('count_urls', ['entities', 'urls'], len_or_none, 'int64'),
+    ('count_media', ['entities', 'media'], len_or_none, 'int64'),
+    ('is_reply', ['in_reply_to_user_id'], is_not_none, 'bool'),
+    ('is_retweet', ['retweeted_status'], is_not_none, 'bool'),
+    ('time_zone', ['user', 'time_zone'], None, 'string')]
+if CONFIG.get('tweet_epoch_ms', False):
+    # created_at as milliseconds since the epoch, so it doesn't need parsing
+    TWEET_FIELDS = TWEET_FIELDS + [('created_at_ms', ['timestamp_ms'], int_or_none, 'int64')]
+
+POST_FIELDS = [
+    ('verb', ['verb'], None, 'string'),
+    ('published', ['object', 'published'], None, 'string'), # date-time stamp
+    ('objectType', ['object', 'objectType'], None, 'string'),
+    ('displayName', ['displayName'], None, 'string'), # title
+    ('permalinkUrl', ['object', 'permalinkUrl'], None, 'string'),
+    ('summary', ['object', 'summary'], None, 'string'),
+    ('content', ['object', 'content'], None, 'string'), # includes some HTML markup
+    ('content_len', ['object', 'content'], len_or_none, 'int64'), # presently includes the HTML markup
+    ('tags', ['object', 'tags'], join_tags('tag'), 'string'),
+    ('categories', ['object', 'tags'], join_tags('category'), 'string'),
+    ('actor_name', ['actor', 'displayName'], None, 'string'),
+    ('actor_id', ['actor', 'id'], None, 'int64'),
+    ('actor_type', ['actor', 'objectType'], None, 'string')]
+
+COMMENT_FIELDS = [
+    ('verb', ['verb'], None, 'string'),
+    ('published', ['published'], None, 'string'), # a date-time stamp
+    ('objectType', ['object', 'objectType'], None, 'string'),
+    ('url', ['object', 'url'], None, 'string'),
+    ('id', ['object', 'id'], None, 'string'),
+    ('content', ['content'], None, 'string'),
+    ('content_len', ['content'], len_or_none, 'int64'),
+    ('target_lang', ['target', 'lang'], None, 'string'),
+    ('target_summary', ['target', 'summary'], None, 'string'),
+    ('target_wpCommentCount', ['target', 'wpCommentCount'], None, 'int64'),
+    ('actor_name', ['actor', 'displayName'], None, 'string'),
+    ('actor_id', ['actor', 'id'], None, 'string'),
+    ('actor_type', ['actor', 'objectType'], None, 'string')]
+
+LIKE_FIELDS = [
+    ('verb', ['verb'], None, 'string'),
+    ('published', ['published'], None, 'string'),
+    ('objectType', ['object', 'objectType'], None, 'string'),
+    ('url', ['object', 'url'], None, 'string'),
+    ('displayName', ['object', 'displayName'], None, 'string'),
+    ('target_name', ['target', 'displayName'], None, 'string'),
+    ('target_objectType', ['target', 'objectType'], None, 'string'),
+    ('actor_name', ['actor', 'displayName'], None, 'string'),
+    ('actor_id', ['actor', 'wpcom:user_id'], None, 'int64'),
+    ('actor_type', ['actor', 'objectType'], None, 'string')]
+
+parse_tweet = compile_field_plan(TWEET_FIELDS)     # Reorganize a tweet
+parse_post = compile_field_plan(POST_FIELDS)       # Parsed subset of a post
+parse_comment = compile_field_plan(COMMENT_FIELDS) # Parsed subset of a comment
+parse_like = compile_field_plan(LIKE_FIELDS)       # Parsed subset of a like
+
+STREAM_TIME_COLUMNS = { # the column with each event's date-time stamp
+    'tweets': 'created_at',
+    'filtered_tweets': 'created_at',
+    'posts': 'published',
+    'comments': 'published',
+    'likes': 'published'}
+
+STREAM_FIELDS = {
+    'tweets': TWEET_FIELDS,
+    'filtered_tweets': TWEET_FIELDS,
+    'posts': POST_FIELDS,
+    'comments': COMMENT_FIELDS,
+    'likes': LIKE_FIELDS}
+
+# How the values of each column type are converted when saving typed columns
+COLUMN_CONVERSIONS = {
+    'string': unicode_or_none,
+    'int64': int_or_none,
+    'bool': bool_or_none}
+if pa is not None:
+    ARROW_TYPES = {
+        'string': pa.string(),
+        'int64': pa.int64(),
+        'bool': pa.bool_()}
+
+## Topic Tagging Functions
+# When topic_tagging is set up, each event gets a topic column with the 
+# topics (from the topics file) whose terms appear in its text columns, such
+# as "debate". Events that don't match any topic can be kept, dropped, or 
+# saved separately (to a compressed CSV file for <stream>_unmatched).
+def load_topics(topic_config):
+    """Return (topic terms, text columns) from the configured topics file,
+    or (None, None) if topic tagging isn't set up"""
+    if not topic_config.get('topics_file'):
+        return None, None
+    with open(topic_config['topics_file']) as f:
+        topics = yaml.safe_load(f)
+    topic_terms = [ # (topic, lower case terms) pairs
+        (topic, [unicode(x).lower() for x in terms])
+        for topic, terms in sorted(topics['topics'].items())]
+    return topic_terms, topics['text_columns']
+
+TOPIC_TERMS, TOPIC_TEXT_COLUMNS = load_topics(CONFIG.get('topic_tagging', {}))
+if TOPIC_TERMS is not None:
+    # The topic column is added by tag_topics, after the event is parsed
+    STREAM_FIELDS = {
+        key: field_plan + [('topic', None, None, 'string')]
+        for key, field_plan in STREAM_FIELDS.items()}
+STREAM_TIME_COLUMNS.update({ # for the separately saved unmatched events
+    "{}_unmatched".format(key): column 
+    for key, column in STREAM_TIME_COLUMNS.items()})
+
+@tz.curry
+def tag_topics(stream_key, stream_iterator):
+    """Add a topic column to each event in the stream"""
+    if TOPIC_TERMS is None:
+        return stream_iterator
+    return tz.map(add_topic(TOPIC_TERMS, TOPIC_TEXT_COLUMNS[stream_key]), stream_iterator)
+
+@tz.curry
+def handle_unmatched(stream_key, stream_iterator):
+    """Handle the events that don't match any topic according to the 
+    unmatched setting. This comes after the counting, so they are still 
+    counted overall."""
+    if TOPIC_TERMS is None:
+        return stream_iterator
+    unmatched = CONFIG['topic_tagging']['unmatched']
+    if unmatched == 'drop':
+        return tz.filter(has_topic, stream_iterator)
+    elif unmatched == 'separate':
+        return route_unmatched(stream_key, stream_iterator)
+    return stream_iterator
+
+@tz.curry
+def add_topic(topic_terms, text_columns, row):
+    """Set the row's topic column to the topics whose terms appear in its
+    text columns (ignoring case), or None if there aren't any"""
+    text = u"\n".join(
+        row[x] for x in text_columns if isinstance(row.get(x), basestring)).lower()
+    topics = [
+        topic for topic, terms in topic_terms 
+        if any(term in text for term in terms)]
+    row['topic'] = ", ".join(topics) if len(topics) > 0 else None
+    return row
+
+def has_topic(row):
+    """Predicate that checks whether a row matched any topic"""
+    return row.get('topic') is not None
+
+def route_unmatched(stream_key, stream_iterator):
+    """Yield the rows that matched a topic, and save the others to a 
+    compressed CSV file for <stream>_unmatched, on a separate thread"""
+    unmatched_queue = Queue.Queue(maxsize=CONFIG['batching']['max_rows'])
+    unmatched_saver = threading.Thread(
+        target=save_csv_gz, 
+        args=("{}_unmatched".format(stream_key), iter(unmatched_queue.get, END_OF_STREAM)))
+    unmatched_saver.daemon = True
+    unmatched_saver.start()
+    try:
+        for row in stream_iterator:
+            if has_topic(row):
+                yield row
+            else:
+                put_while_alive(unmatched_queue, row, unmatched_saver)
+    finally:
+        put_while_alive(unmatched_queue, END_OF_STREAM, unmatched_saver)
+        unmatched_saver.join()
+
+## Per-Minute Counting Functions
+# Each consumer counts the events it receives in each minute (overall, and for
+# each topic), and saves the counts every interval seconds to CSV files in the
+# same format as data/demdebate/count.sql, such as overall_count/count_posts.csv
+# and debate_count/count_posts.csv.
+STREAM_VERBS = { # the verb column of the counts
+    'tweets': 'tweet',
+    'filtered_tweets': 'tweet',
+    'posts': 'post',
+    'comments': 'comment',
+    'likes': 'like'}
+
+@tz.curry
+def count_per_minute(stream_key, stream_iterator):
+    """Pass the events in the stream through, counting them in each minute
+    and saving the counts every interval seconds (if per_minute_counts is 
+    set up)"""
+    interval = CONFIG.get('per_minute_counts', {}).get('interval')
+    if not interval:
+        return stream_iterator
+    return counting_stream(stream_key, stream_iterator, interval)
+
+def counting_stream(stream_key, stream_iterator, interval):
+    """Yield the events in the stream, counting them in each minute, and 
+    saving the counts every interval seconds and once the stream ends"""
+    counts = load_minute_counts(stream_key) # {'overall' or topic: {minute: num_entries}}
+    time_column = STREAM_TIME_COLUMNS[stream_key]
+    saved_at = time.time()
+    try:
+        for row in stream_iterator:
+            add_to_minute_counts(counts, row, time_column)
+            yield row
+            if time.time() - saved_at >= interval:
+                save_minute_counts(stream_key, counts)
+                saved_at = time.time()
+    finally:
+        save_minute_counts(stream_key, counts)
+
+def add_to_minute_counts(counts, row, time_column):
+    """Count the row in its minute, overall and for each of its topics"""
+    minute = (row.get(time_column) or '')[:16] # such as 2015-10-14T01:23
+    if minute == '':
+        return counts
+    topics = (row.get('topic') or '').split(", ")
+    for group in ['overall'] + [x for x in topics if x != '']:
+        group_counts = counts.setdefault(group, {})
+        group_counts[minute] = group_counts.get(minute, 0) + 1
+    return counts
+
+def load_minute_counts(stream_key):
+    """Return the counts already saved for the stream, so a restarted 
+    consumer adds to them"""
+    groups = ['overall'] + [topic for topic, _ in (TOPIC_TERMS or [])]
+    counts = {}
+    for group in groups:
+        file_name = get_count_location(stream_key, group)
+        if os.path.exists(file_name):
+            with open(file_name, 'rb') as f:
+                counts[group] = {
+                    row['minute']: int(row['num_entries']) for row in csv.DictReader(f)}
+    return counts
+
+def save_minute_counts(stream_key, counts):
+    """Save each group's counts, replacing the files all at once so they're
+    never read half written. If they can't be saved, that is logged and the
+    stream carries on (they are saved again at the next interval)."""
+    try:
+        for group, group_counts in counts.items():
+            file_name = get_count_location(stream_key, group)
+            if not os.path.exists(os.path.dirname(file_name)):
+                os.makedirs(os.path.dirname(file_name))
+            with open(file_name + ".tmp", 'wb') as f:
+                writer = csv.writer(f)
+                writer.writerow(['num_entries', 'minute', 'verb'])
+                for minute, num_entries in sorted(group_counts.items()):
+                    writer.writerow([num_entries, minute, STREAM_VERBS[stream_key]])
+            os.rename(file_name + ".tmp", file_name)
+    except (IOError, OSError) as e:
+        write_to_log(stream_key, "Couldn't save the per-minute counts ({!r})\n".format(e))
+        return False
+    return True
+
+def get_count_location(stream_key, group):
+    """Return the file for a stream's per-minute counts, overall or for a topic"""
+    return os.path.join(
+        CONFIG['per_minute_counts']['folder'],
+        "{}_count".format(group),
+        "count_{}.csv".format(stream_key))
 
 ## Saving Functions
 def save_first(stream_key, stream_iterator):
@@ -293,55 +814,450 @@ def save_first(stream_key, stream_iterator):
     return True
 
 def save_sqlite(stream_key, stream_iterator):
-    """Save the given stream to a database, such as SQLite."""
-    db_engine = sqlal.create_engine(
-            'sqlite:///{}'.format(get_save_location(stream_key, '.sqlite')))
-    save_size = {'debug':10, 'production': 1000}
-    stored_stream = []
+    """Save the given stream to a SQLite database
+    
+    The table is created from the stream's field plan, and a single 
+    connection is kept open for the life of the stream. Each batch of rows 
+    is inserted with one executemany in its own transaction."""
+    field_plan = STREAM_FIELDS[stream_key]
+    connection = open_sqlite(get_save_location(stream_key, '.sqlite'), CONFIG['sqlite'])
+    insert_statement = create_sqlite_table(connection, 'stream', field_plan)
     try: 
-        for num, row in enumerate(stream_iterator):
-            stored_stream.append(row)
-            if (num % save_size[CONFIG['mode']]) == 0 and num != 0: # occasionally save to disc
-                stored_frame = pd.DataFrame(stored_stream)
-                stored_frame.to_sql('stream', db_engine, if_exists='append', index=False)
-                stored_stream = []
-                log_update(stream_key, num)   # feedback for debugging
-    except KeyboardInterrupt:
-        # Save in-memory data when it receives a SIGINT
-        stored_frame = pd.DataFrame(stored_stream)
-        stored_frame.to_sql('stream', db_engine, if_exists='append', index=False)
-        log_update(stream_key, num)   # feedback for debugging
-            
+        save_in_batches(
+            stream_key, 
+            stream_iterator, 
+            lambda x: insert_sqlite_rows(connection, insert_statement, field_plan, x))
+    finally:
+        connection.close()
+    return True
+
+def open_sqlite(file_name, sqlite_config):
+    """Return a connection to the given SQLite database, set up for 
+    frequent appends"""
+    connection = sqlite3.connect(file_name, check_same_thread=False) # for the writer thread
+    connection.execute("pragma journal_mode=WAL") # appends don't rewrite pages
+    connection.execute("pragma synchronous={}".format(sqlite_config['synchronous']))
+    connection.execute("pragma cache_size={:d}".format(sqlite_config['cache_size']))
+    return connection
+
+def create_sqlite_table(connection, table_name, field_plan):
+    """Create the table for the given field plan (if it doesn't already 
+    exist), add any of the plan's columns it is missing, and return the 
+    statement for inserting rows into it"""
+    sqlite_types = {'string': 'TEXT', 'int64': 'INTEGER', 'bool': 'INTEGER'}
+    columns = [column for column, _, _, _ in field_plan]
+    connection.execute("create table if not exists {} ({})".format(
+        table_name,
+        ", ".join(
+            '"{}" {}'.format(column, sqlite_types[column_type])
+            for column, _, _, column_type in field_plan)))
+    existing_columns = [
+        x[1] for x in connection.execute("pragma table_info({})".format(table_name))]
+    for column, _, _, column_type in field_plan:
+        if column not in existing_columns: # such as topic, or created_at_ms
+            connection.execute('alter table {} add column "{}" {}'.format(
+                table_name, column, sqlite_types[column_type]))
+    connection.commit()
+    return "insert into {} ({}) values ({})".format(
+        table_name,
+        ", ".join('"{}"'.format(column) for column in columns),
+        ", ".join("?" for _ in columns))
+
+def insert_sqlite_rows(connection, insert_statement, field_plan, rows):
+    """Insert the given rows in a single transaction"""
+    conversions = [
+        (column, COLUMN_CONVERSIONS[column_type]) 
+        for column, _, _, column_type in field_plan]
+    with connection: # commits, or rolls back if there is an error
+        connection.executemany(
+            insert_statement,
+            ([convert(row.get(column)) for column, convert in conversions] for row in rows))
     return True
 
 def save_csv_gz(stream_key, stream_iterator):
-    """Save the given stream to a compressed CSV file
+    """Save the given stream to a series of compressed CSV files
     
     This is presently designed to write the rows in chunks
     rather than row by row. My thought was that if there was 
     overhead to each write, this chunking would reduce the number 
-    of times the program needed to deal with that."""
-    file_name = get_save_location(
+    of times the program needed to deal with that.
+
+    A new file (segment) is started whenever the present one passes one of 
+    the limits in the csv_gz_rotation configuration. Each segment is closed 
+    cleanly, and described in a manifest, when the next one starts.
+
+    Each chunk of rows is compressed as a separate gzip member, so if the
+    process is killed, everything but the chunk it was writing can still 
+    be read (gzip readers treat a series of members as one file)."""
+    csv_gz_file = {'segment': None} # the segment presently being written
+    try:
+        save_in_batches(
+            stream_key, 
+            stream_iterator, 
+            lambda x: write_csv_gz_rows(stream_key, csv_gz_file, x))
+    finally:
+        if csv_gz_file['segment'] is not None:
+            close_csv_gz_segment(stream_key, csv_gz_file['segment'])
+    return True
+
+def write_csv_gz_rows(stream_key, csv_gz_file, rows):
+    """Write the given rows to the present segment, first starting a new 
+    segment if needed
+
+    The write is all or nothing, so retrying a batch doesn't duplicate 
+    rows. If it fails part way (such as in the fsync, after the member was
+    written), the CSV buffer is emptied and the file is cut back to where
+    the write started. If even that fails, the segment is closed and the
+    retry starts a new one."""
+    segment = csv_gz_file['segment']
+    if segment is None or should_rotate(segment, CONFIG['csv_gz_rotation']):
+        if segment is not None:
+            close_csv_gz_segment(stream_key, segment)
+            csv_gz_file['segment'] = None
+        segment = open_csv_gz_segment(stream_key, get_csv_fieldnames(stream_key, rows[0]))
+        csv_gz_file['segment'] = segment
+    start = segment['raw_file'].tell()
+    try:
+        segment['writer'].writerows(rows)
+        write_gzip_member(segment, CONFIG['csv_gz_fsync'])
+    except Exception:
+        try:
+            undo_partial_write(segment, start)
+        except Exception:
+            csv_gz_file['segment'] = None
+            close_csv_gz_segment(stream_key, segment)
+        raise
+    time_column = STREAM_TIME_COLUMNS.get(stream_key, 'published')
+    timestamps = [row[time_column] for row in rows if row.get(time_column)]
+    if len(timestamps) > 0:
+        if segment['first_timestamp'] is None or min(timestamps) < segment['first_timestamp']:
+            segment['first_timestamp'] = min(timestamps)
+        if segment['last_timestamp'] is None or max(timestamps) > segment['last_timestamp']:
+            segment['last_timestamp'] = max(timestamps)
+    segment['rows'] += len(rows)
+    return True
+
+def get_csv_fieldnames(stream_key, row):
+    """Return the CSV columns in the order of the stream's field plan 
+    (with any columns the plan doesn't have, such as topic, after them)"""
+    plan_columns = [
+        column for column, _, _, _ in 
+        STREAM_FIELDS.get(stream_key.replace("_unmatched", ""), [])]
+    return plan_columns + sorted(x for x in row.keys() if x not in plan_columns)
+
+def open_csv_gz_segment(stream_key, fieldnames):
+    """Start a new compressed CSV file, and write its header"""
+    base_name = get_save_location(
         stream_key, 
-        "_{}.csv.gz".format(time.strftime("%Y-%m-%d_%I-%M-%S"))) 
+        "_{}".format(time.strftime("%Y-%m-%d_%H-%M-%S"))) 
         # timestamp, to prevent overwriting when starting a new file
-    save_size = {'debug':10, 'production': 1000}
-    with gzip.open(file_name, "w") as f :
-        stored_stream = []
-        try: 
-            for num, row in enumerate(stream_iterator):
-                stored_stream.append(row)
-                if num == 0:
-                    writer = csv.DictWriter(f, fieldnames=row.keys())
-                    writer.writeheader()
-                if (num % save_size[CONFIG['mode']]) == 0 and num != 0:
-                    writer.writerows(stored_stream) # save stored stream entries
-                    stored_stream = []              # reset storage
-                    log_update(stream_key, num)     # feedback for debugging
-        except KeyboardInterrupt:
-            # Save in-memory data and close the file when it receives a SIGINT
-            writer.writerows(stored_stream) # save stored stream entries
-            log_update(stream_key, num)     # feedback for debugging
+    file_name = base_name + ".csv.gz"
+    suffix = 1
+    while os.path.exists(file_name): # another segment started in the same second
+        file_name = "{}_{}.csv.gz".format(base_name, suffix)
+        suffix += 1
+    csv_buffer = cStringIO.StringIO()
+    writer = csv.DictWriter(csv_buffer, fieldnames=fieldnames)
+    writer.writeheader()
+    segment = {
+        'file_name': file_name,
+        'raw_file': open(file_name, "wb"),
+        'csv_buffer': csv_buffer, # the CSV for the chunk being written
+        'writer': writer,
+        'rows': 0,
+        'opened_at': time.time(),
+        'first_timestamp': None,  # earliest event time in the segment
+        'last_timestamp': None}   # latest event time in the segment
+    write_gzip_member(segment, CONFIG['csv_gz_fsync']) # the header
+    return segment
+
+def write_gzip_member(segment, fsync):
+    """Compress whatever CSV is in the segment's buffer, and append it to 
+    the segment's file as a complete gzip member"""
+    with gzip.GzipFile(fileobj=segment['raw_file'], mode="wb") as member:
+        member.write(segment['csv_buffer'].getvalue())
+    segment['csv_buffer'].seek(0)
+    segment['csv_buffer'].truncate()
+    segment['raw_file'].flush()
+    if fsync:
+        os.fsync(segment['raw_file'].fileno()) # make sure it has reached the disk
+    return True
+
+def undo_partial_write(segment, start):
+    """Empty the segment's CSV buffer, and cut its file back to start"""
+    segment['csv_buffer'].seek(0)
+    segment['csv_buffer'].truncate()
+    segment['raw_file'].seek(start)
+    segment['raw_file'].truncate()
+    return True
+
+def should_rotate(segment, rotation):
+    """Predicate to check whether the given segment has passed any of the 
+    rotation limits, which are checked between chunks of rows"""
+    interval = rotation.get('interval')
+    return any([
+        rotation.get('max_rows') and segment['rows'] >= rotation['max_rows'],
+        rotation.get('max_bytes') and segment['raw_file'].tell() >= rotation['max_bytes'],
+        # intervals are aligned to the clock, so 3600 rotates on the hour
+        interval and int(time.time() // interval) != int(segment['opened_at'] // interval)])
+
+def close_csv_gz_segment(stream_key, segment):
+    """Finish a compressed CSV file and add it to the stream's manifest"""
+    segment['raw_file'].close()
+    manifest_name = get_save_location(stream_key, "_manifest.csv")
+    is_new_file = not os.path.exists(manifest_name)
+    with open(manifest_name, 'ab') as f:
+        writer = csv.writer(f)
+        if is_new_file:
+            writer.writerow(['file_name', 'rows', 'first_timestamp', 'last_timestamp'])
+        writer.writerow([
+            os.path.basename(segment['file_name']),
+            segment['rows'],
+            segment['first_timestamp'],
+            segment['last_timestamp']])
+    return True
+
+def save_parquet(stream_key, stream_iterator):
+    """Save the given stream to Parquet files, partitioned by the hour
+
+    Each batch of rows is written as a row group of typed columns. The 
+    column types come from the stream's field plan. The rows are partitioned
+    by the hour (UTC) of their date-time stamp, with a file for each hour 
+    that rows are being saved in, in folders like:
+    data/posts_stream_parquet/date=2015-10-13/hour=23/"""
+    if pa is None:
+        raise ImportError("Saving to parquet requires the pyarrow library")
+    field_plan = STREAM_FIELDS[stream_key]
+    schema = pa.schema([
+        pa.field(column, ARROW_TYPES[column_type]) 
+        for column, _, _, column_type in field_plan])
+    parquet_files = {} # {partition: the writer for its present file}
+    written = {'batch': None, 'partitions': set()} # the partitions of a failed batch already written
+    try:
+        save_in_batches(
+            stream_key, 
+            stream_iterator, 
+            lambda x: write_row_groups(stream_key, schema, field_plan, parquet_files, written, x))
+    finally:
+        for writer in parquet_files.values():
+            writer.close() # writes the file's footer
+    return True
+
+def write_row_groups(stream_key, schema, field_plan, parquet_files, written, rows):
+    """Write the given rows as a row group in the file for each hour they 
+    were stamped in, closing the files of hours without any rows in the 
+    batch (so only the hours still arriving are kept open)
+
+    The partitions written so far are recorded in written, so when a write
+    fails and the same batch is retried, the partitions that were already
+    written are skipped rather than written twice."""
+    if written['batch'] is not rows: # a new batch, rather than a retry
+        written['batch'] = rows
+        written['partitions'] = set()
+    time_column = STREAM_TIME_COLUMNS[stream_key]
+    partitions = tz.groupby(lambda x: get_partition(x.get(time_column)), rows)
+    for partition in [x for x in parquet_files if x not in partitions]:
+        parquet_files.pop(partition).close()
+    for partition, partition_rows in sorted(partitions.items()):
+        if partition in written['partitions']:
+            continue # written before a later partition failed
+        if partition not in parquet_files:
+            parquet_files[partition] = open_parquet_file(stream_key, schema, partition)
+        columns = [
+            pa.array(
+                [COLUMN_CONVERSIONS[column_type](row.get(column)) for row in partition_rows], 
+                type=ARROW_TYPES[column_type])
+            for column, _, _, column_type in field_plan]
+        parquet_files[partition].write_table(pa.Table.from_arrays(columns, schema=schema))
+        written['partitions'].add(partition)
+    written['batch'] = None # the whole batch is written
+    return True
+
+def get_partition(timestamp):
+    """Return the partition folder for the hour (UTC) of the given date-time
+    stamp (such as 2015-10-13T23:42:11Z), or the present hour if it has none"""
+    try:
+        hour = dt.datetime.strptime(timestamp[:13], "%Y-%m-%dT%H")
+    except (TypeError, ValueError):
+        hour = dt.datetime.utcnow()
+    return hour.strftime("date=%Y-%m-%d/hour=%H")
+
+def open_parquet_file(stream_key, schema, partition):
+    """Start a new Parquet file in the given partition's folder"""
+    folder = get_save_location(stream_key, "_parquet/{}".format(partition))
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    base_name = "{}/part_{}".format(folder, dt.datetime.utcnow().strftime("%Y-%m-%d_%H-%M-%S"))
+    file_name = base_name + ".parquet"
+    suffix = 1
+    while os.path.exists(file_name): # the hour was reopened in the same second
+        file_name = "{}_{}.parquet".format(base_name, suffix)
+        suffix += 1
+    return pq.ParquetWriter(file_name, schema, compression='snappy')
+
+## Batching Functions
+def save_in_batches(stream_key, stream_iterator, write_batch):
+    """Save a stream by passing each batch from batch_stream to write_batch
+
+    This is shared by all of the saving functions. The batches are written
+    by a separate writer thread (see write_batches), so reading the stream 
+    only waits on the disk when the bounded queue between them is full."""
+    batching = CONFIG['batching']
+    batch_queue = Queue.Queue(maxsize=batching['writer_queue_size'])
+    writer = threading.Thread(
+        target=write_batches, args=(stream_key, batch_queue, write_batch))
+    writer.daemon = True
+    writer.start()
+    try:
+        for batch, batch_bytes in batch_stream(stream_iterator, batching):
+            put_while_alive(batch_queue, (batch, batch_bytes, time.time()), writer)
+    except KeyboardInterrupt:
+        STOP_EVENT.set() # so a writer blocked on a failing write spills instead
+        raise
+    finally:
+        put_while_alive(batch_queue, END_OF_STREAM, writer)
+        writer.join()
+    return True
+
+def write_batches(stream_key, batch_queue, write_batch):
+    """Pass each batch on the queue to write_batch, until END_OF_STREAM
+
+    If a write fails, the batch is kept in memory and retried along with 
+    the next one. Once the batches kept in memory pass the memory_ceiling, 
+    it either keeps retrying without taking any more batches from the queue
+    ('block'), or moves them to a spill file on disk ('spill'). The spill 
+    file is written out once the writes succeed again."""
+    batching = CONFIG['batching']
+    spill_file = get_save_location(stream_key, "_spill.jsonl")
+    unwritten = [] # (batch, size in bytes) pairs that haven't been written yet
+    num_rows = 0
+    for batch, batch_bytes, queued_at in iter(batch_queue.get, END_OF_STREAM):
+        queue_lag = time.time() - queued_at # how far the writer is behind
+        unwritten.append((batch, batch_bytes))
+        attempt = 0
+        while len(unwritten) > 0:
+            try:
+                write_batch(unwritten[0][0])
+            except Exception as e:
+                unwritten_bytes = sum(x[1] for x in unwritten)
+                write_to_log(stream_key, "Couldn't save a batch ({!r}), {} bytes unsaved\n".format(
+                    e, unwritten_bytes))
+                if unwritten_bytes < batching['memory_ceiling']:
+                    break # try again with the next batch
+                elif batching['when_full'] == 'spill' or STOP_EVENT.is_set():
+                    spill_rows(spill_file, tz.concat(x[0] for x in unwritten))
+                    unwritten = []
+                else: # block, by retrying before taking any more batches
+                    STOP_EVENT.wait(backoff_delay(attempt, 1, 60))
+                    attempt += 1
+                continue
+            written, written_bytes = unwritten.pop(0)
+            num_rows += len(written)
+            log_update(stream_key, num_rows, 
+                "batch_rows={} batch_bytes={} unsaved_bytes={} writer_queue={} queue_lag={:.2f}s".format(
+                len(written), written_bytes, sum(x[1] for x in unwritten),
+                batch_queue.qsize(), queue_lag))
+        if len(unwritten) == 0 and os.path.exists(spill_file):
+            num_rows += unspill_rows(stream_key, spill_file, write_batch, batching['max_rows'])
+    if len(unwritten) > 0: # the stream has ended, so keep what is left on disk
+        spill_rows(spill_file, tz.concat(x[0] for x in unwritten))
+
+def put_while_alive(given_queue, item, thread):
+    """Put item on the queue, waiting while it is full, unless the thread
+    taking items off of it has stopped"""
+    while thread.is_alive():
+        try:
+            given_queue.put(item, timeout=1)
+            return True
+        except Queue.Full:
+            pass
+    raise RuntimeError("The writer thread stopped unexpectedly")
+
+def batch_stream(stream_iterator, batching):
+    """Yield (batch, size in bytes) pairs of the rows in the stream
+
+    A batch is yielded once it has max_rows rows, about max_bytes of data, 
+    or when a row arrives max_latency seconds after the batch was started.
+    The rows in memory are also yielded when the stream ends or it receives 
+    a SIGINT, which also sets STOP_EVENT as connect_to_all_streams does."""
+    max_rows = 10 if CONFIG['mode'] == 'debug' else batching['max_rows']
+    batch = []
+    batch_bytes = 0
+    batch_started = time.time()
+    try:
+        for row in stream_iterator:
+            if len(batch) == 0:
+                batch_started = time.time()
+            batch.append(row)
+            batch_bytes += estimate_row_size(row)
+            if (len(batch) >= max_rows or 
+                    batch_bytes >= batching['max_bytes'] or
+                    time.time() - batch_started >= batching['max_latency']):
+                yield batch, batch_bytes
+                batch = []
+                batch_bytes = 0
+    except KeyboardInterrupt:
+        STOP_EVENT.set() # stop reading, and stop a blocked writer retrying, on a SIGINT
+    if len(batch) > 0:
+        yield batch, batch_bytes
+
+def estimate_row_size(row):
+    """Roughly estimate the number of bytes a parsed row takes up"""
+    return sum(
+        len(x) if isinstance(x, basestring) else 8
+        for x in row.itervalues())
+
+def spill_rows(spill_file, rows):
+    """Append the given rows to a spill file, one JSON object per line"""
+    with open(spill_file, 'a') as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+    return True
+
+def unspill_rows(stream_key, spill_file, write_batch, batch_size):
+    """Write the rows in a spill file in batches, removing the file once
+    they have all been written. If a batch can't be written, the file is 
+    replaced with the rows from that batch on, so the batches already 
+    written aren't written again. Returns the number of rows written."""
+    num_rows = 0
+    try:
+        with open(spill_file) as f:
+            for lines in tz.partition_all(batch_size, f):
+                try:
+                    write_batch([json.loads(x) for x in lines])
+                except Exception:
+                    keep_unwritten_lines(spill_file, tz.concat([lines, f]))
+                    raise
+                num_rows += len(lines)
+    except Exception as e:
+        write_to_log(stream_key, "Couldn't save spilled rows ({!r})\n".format(e))
+        return num_rows
+    os.remove(spill_file)
+    return num_rows
+
+def keep_unwritten_lines(spill_file, lines):
+    """Replace the spill file with the given lines, all at once"""
+    with open(spill_file + ".tmp", 'w') as f:
+        f.writelines(lines)
+    os.rename(spill_file + ".tmp", spill_file)
+    return True
+
+def record_gap(stream_key, gap_start, gap_end, events_per_second):
+    """Save a row describing a gap in the stream to a sidecar CSV file
+
+    The number of events lost is estimated from the rate that events arrived
+    while the stream was connected."""
+    file_name = get_save_location(stream_key, "_gaps.csv")
+    is_new_file = not os.path.exists(file_name)
+    with open(file_name, 'ab') as f:
+        writer = csv.writer(f)
+        if is_new_file:
+            writer.writerow(['gap_start', 'gap_end', 'seconds', 'estimated_events_lost'])
+        writer.writerow([
+            dt.datetime.utcfromtimestamp(gap_start).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            dt.datetime.utcfromtimestamp(gap_end).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            int(round(gap_end - gap_start)),
+            int(round((gap_end - gap_start) * events_per_second))])
     return True
 
 def write_to_log(stream_key, what_to_write):
@@ -365,13 +1281,6 @@ def get_value_if_present_nested(given_dict, key_list):
     # rename function to: get_in_reordered
     return reduce(get_value_if_present, key_list, given_dict)
 
-def len_or_none(given_item):
-    """If it has one, return length, otherwise return None"""
-    try: 
-        return len(given_item)
-    except:
-        return None
-
 def get_save_location(stream_key, file_ending):
     return "../data/{}_stream{}".format(stream_key, file_ending)
 
@@ -380,30 +1289,71 @@ def print_and_pass(given_item):
     print(given_item)
     return given_item
 
-def log_update(stream_key, num):
+def log_update(stream_key, num, details=""):
     """Save a small update on how things are going"""
-    update = "{} {} {}".format(
+    update = "{} {} {} {}".format(
         stream_key.ljust(8), 
         dt.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
-        num)
+        num,
+        details).rstrip()
     write_to_log(stream_key, update+"\n")
     print(update)
 
+def log_buffer_stats(stream_key, queue_depth, stats):
+    """Save a small update on how full a stream's read buffer is"""
+    update = "{} {} queue_depth={} max_queue_depth={} dropped_lines={}".format(
+        stream_key.ljust(8), 
+        dt.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        queue_depth,
+        stats['max_queue_depth'],
+        stats['dropped_lines'])
+    write_to_log(stream_key, update+"\n")
+    print(update)
+
+def get_json_decoder(decoder_name):
+    """Return the loads function of the named JSON library
+
+    'auto' picks the first of orjson, ujson, or simdjson that is installed.
+    If the library isn't installed, it falls back to the standard json 
+    module."""
+    if decoder_name == 'auto':
+        module_names = ['orjson', 'ujson', 'simdjson', 'json']
+    else:
+        module_names = [decoder_name, 'json']
+    for module_name in module_names:
+        try:
+            return importlib.import_module(module_name).loads
+        except ImportError:
+            pass
+
+JSON_LOADS = get_json_decoder(CONFIG.get('json_decoder', 'auto'))
+
 def permissive_json_load(given_item):
     """A version of json.loads that returns an empty dictionary if
     the given_item can't be decoded"""
     try:
-        return json.loads(given_item)
+        return JSON_LOADS(given_item)
     except:
         return {}
 
-def print_twitter_stall_warning(given_item):
+@tz.curry
+def print_twitter_stall_warning(stream_key, given_item):
     """Print stall warnings, pass everything through"""
     warning = tz.get_in(['warning'], given_item, default = None)
     if warning is not None:
-        write_to_log(STREAM_KEY, warning)
-        print(warning) 
+        message = format_stall_warning(warning)
+        write_to_log(stream_key, message + "\n")
+        print(message) 
     return(given_item)
 
+def format_stall_warning(warning):
+    """Return a line describing a Twitter stall warning, such as 
+    {'code': 'FALLING_BEHIND', 'message': '...', 'percent_full': 60}"""
+    return "{} stall warning {}: {} ({}% full)".format(
+        dt.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        tz.get_in(['code'], warning, default=None),
+        tz.get_in(['message'], warning, default=warning),
+        tz.get_in(['percent_full'], warning, default=None))
+
 if __name__ == '__main__':
     main()
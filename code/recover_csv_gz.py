@@ -0,0 +1,125 @@
+## Salvage the complete rows from a damaged or truncated .csv.gz file
+##
+## The stream consumers write each chunk of rows as a separate gzip member,
+## so when a consumer is killed only the last member is damaged. This reads
+## every member it can, and saves their rows to a new file. The rows of a 
+## complete member are only kept once its checksum (CRC) has been checked. 
+## Those at the start of a damaged member are kept if they were decoded 
+## before the damage (or any zeroed tail) and have as many fields as the 
+## header. It can be run with: 
+## `python recover_csv_gz.py damaged.csv.gz [recovered.csv.gz]`
+
+import zlib                  # for decompressing the gzip members directly
+import gzip                  # for compression of the recovered CSV
+import csv                   # for reading and writing the rows
+import sys                   # for interacting with the system
+import argparse              # for accepting command line arguments
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS # tells zlib to expect a gzip header
+CHUNK_SIZE = 2**20               # bytes read from the damaged file at a time
+SALVAGE_STEP = 2**12             # bytes decoded at a time from a damaged member
+
+## Accept Arguments
+parser = argparse.ArgumentParser(description="Salvage rows from a damaged .csv.gz file")
+parser.add_argument('damaged_file', type=str, help='The damaged .csv.gz file')
+parser.add_argument('recovered_file', type=str, nargs='?', default=None,
+                    help='Where to save the recovered rows (default: <damaged_file>.recovered.csv.gz)')
+
+## Main Functions
+def main():
+    """Recover the rows from the file given on the command line"""
+    args = parser.parse_args()
+    recovered_file = args.recovered_file or args.damaged_file.replace(
+        ".csv.gz", ".recovered.csv.gz")
+    num_rows = recover_csv_gz(args.damaged_file, recovered_file)
+    print("Recovered {} rows (including the header) to {}".format(num_rows, recovered_file))
+
+def recover_csv_gz(damaged_file, recovered_file):
+    """Save every complete row in damaged_file to recovered_file, returning
+    the number of rows saved"""
+    csv.field_size_limit(sys.maxsize)
+    num_rows = 0
+    header = None
+    with gzip.open(recovered_file, "wb") as f:
+        writer = csv.writer(f)
+        for data, is_checked in iterate_members(damaged_file):
+            reader = csv.reader( # strict, so a row cut off inside quotes raises
+                iterate_complete_lines([data]), strict=True)
+            try:
+                for row in reader:
+                    header = header or row
+                    if is_checked or len(row) == len(header):
+                        writer.writerow(row)
+                        num_rows += 1
+            except csv.Error:
+                pass # the last row was cut off inside a quoted field
+    return num_rows
+
+## Helper Functions
+def iterate_members(file_name):
+    """Yield (decompressed data, whether its CRC was checked) for each gzip
+    member in the file, stopping after the first one that is damaged or
+    cut off (which is salvaged instead)"""
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    member_data = []  # decompressed so far, from the present member
+    member_input = [] # read so far, for the present member
+    with open(file_name, "rb") as f:
+        for data in iter(lambda: f.read(CHUNK_SIZE), ''):
+            while len(data) > 0:
+                try:
+                    member_data.append(decompressor.decompress(data))
+                except zlib.error:
+                    member_input.append(data)
+                    yield salvage_member(''.join(member_input)), False
+                    return # damaged, there is nothing more to recover
+                # Anything after the end of a member is the start of the next
+                unused_data = decompressor.unused_data
+                member_input.append(data[:len(data) - len(unused_data)])
+                if len(unused_data) > 0 or has_ended(decompressor):
+                    yield ''.join(member_data), True
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+                    member_data, member_input = [], []
+                data = unused_data
+    if len(member_input) > 0: # cut off before the end of the member
+        yield salvage_member(''.join(member_input)), False
+
+def has_ended(decompressor):
+    """Return whether the decompressor has reached the end of its member 
+    (and so checked its CRC), by seeing if a copy of it leaves any more 
+    data unused"""
+    probe = decompressor.copy()
+    try:
+        probe.decompress('\0')
+    except zlib.error:
+        return False
+    return len(probe.unused_data) > 0
+
+def salvage_member(member_input):
+    """Return the data that can be decompressed from a damaged member, 
+    decoding it in small steps so what came before the damage is kept, and
+    leaving off any zeroed tail (which would decode to made up rows)"""
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    data = member_input.rstrip('\0')
+    salvaged = []
+    while len(data) > 0:
+        try:
+            salvaged.append(decompressor.decompress(data, SALVAGE_STEP))
+        except zlib.error:
+            break # the damage
+        if len(decompressor.unconsumed_tail) == len(data):
+            break # nothing more can be decoded from what's left
+        data = decompressor.unconsumed_tail
+    return ''.join(salvaged)
+
+def iterate_complete_lines(chunks):
+    """Yield the complete lines in the given chunks of text, leaving off
+    any final line that wasn't finished"""
+    remainder = ''
+    for chunk in chunks:
+        lines = (remainder + chunk).split('\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,20 @@
-# Run all the stream consumers as background processes
+# Run all the stream consumers as a single background process
 
 # For Development
 find . -name '*.pyc' -delete # remove compiled files
 
-nohup python consumer_functions.py comments &
+# Consumes each of the streams listed under all_streams in config.yaml
+nohup python consumer_functions.py all &
 echo $! >> consumers.pid # save the pid's, to make it easier to stop them
-nohup python consumer_functions.py posts &
-echo $! >> consumers.pid
-nohup python consumer_functions.py likes &
-echo $! >> consumers.pid
-nohup python consumer_functions.py tweets &
-echo $! >> consumers.pid
+
+# To run each stream as a separate process instead:
+# nohup python consumer_functions.py comments &
+# echo $! >> consumers.pid
+# nohup python consumer_functions.py posts &
+# echo $! >> consumers.pid
+# nohup python consumer_functions.py likes &
+# echo $! >> consumers.pid
+# nohup python consumer_functions.py tweets &
+# echo $! >> consumers.pid
 # nohup python consumer_functions.py filtered_tweets &
 # echo $! >> consumers.pid
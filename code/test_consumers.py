@@ -3,6 +3,7 @@
 
 import consumer_functions as cf
 import json
+import threading
 
 ## Tests of Parsing Functions
 def test_parse_tweet():
@@ -43,12 +44,289 @@ def test_parse_tweet():
     test6 = cf.parse_tweet({})
     assert test6['created_at'] == ""
 
+    test7 = cf.parse_tweet({'created_at': ['not', 'hashable']})
+    assert test7['created_at'] == "['not', 'hashable']"
+
+def test_reformat_timestamp():
+    for _ in range(2): # the second time is from the cache
+        assert cf.reformat_timestamp("Sat Oct 10 14:48:34 +0000 2015") == "2015-10-10T14:48:34Z"
+        assert cf.reformat_timestamp("Sat Oct 10 14:48:34 2015") == "Sat Oct 10 14:48:34 2015"
+        assert cf.reformat_timestamp(None) == ""
+
+def test_int_or_none():
+    assert cf.int_or_none(u'1444170451657') == 1444170451657
+    assert cf.int_or_none(None) is None
+    assert cf.int_or_none('what the what') is None
+
+def test_parse_post():
+    with open("test_data/example_posts.json", 'r') as f:
+        result = cf.parse_post(json.loads(f.read()))
+        assert result == {
+            'actor_id': 53907243,
+            'actor_name': u'viralhose',
+            'actor_type': u'person',
+            'categories': u'seattle',
+            'content': u'Freshly cut down plum tree. When seasoned,this hardwood burns hot and long! Also,excellent as smoker wood.The branches can be used right away for that. We will help cut into 6\' pieces,no smaller. We are right off 4th Ave W and Evergreen Way<br><br><a href="http://ift.tt/1LcGDw9">View Item</a><br>',
+            'content_len': 297,
+            'displayName': u'Plum tree wood and branches. (S. Everett)',
+            'objectType': u'article',
+            'permalinkUrl': u'http://worldsbiggestfreestuffsite.wordpress.com/2015/10/04/plum-tree-wood-and-branches-s-everett/',
+            'published': u'2015-10-04T23:37:46Z',
+            'summary': u'Freshly cut down plum tree. When seasoned,this hardwood burns hot and long! Also,excellent as smoker wood.The branches can be used right away for that. We will help cut into 6&#8242; pieces,no smaller. We are right off 4th Ave W and Evergreen Way View Item',
+            'tags': u'free, seattle, stuff',
+            'verb': u'post'}
+
+    test1 = cf.parse_post({'object': 'not a dictionary'})
+    assert test1['content'] is None
+    assert test1['content_len'] is None
+    assert test1['tags'] == ''
+
+def test_parse_comment():
+    with open("test_data/example_comments.json", 'r') as f:
+        result = cf.parse_comment(json.loads(f.read()))
+        assert result['id'] == u'266392'
+        assert result['content_len'] == 518
+        assert result['target_wpCommentCount'] == 144
+        assert result['url'] == u'https://zanquetta.wordpress.com/2015/10/04/gracias-osorio#comment-266392'
+        assert result['actor_id'] == u'47396229'
+        assert len(result) == 13
+
+def test_parse_like():
+    with open("test_data/example_likes.json", 'r') as f:
+        result = cf.parse_like(json.loads(f.read()))
+        assert result == {
+            'actor_id': 59475549,
+            'actor_name': u'friedova',
+            'actor_type': u'person',
+            'displayName': u'Giant Swallowtail / Grande Porte-queue',
+            'objectType': u'post',
+            'published': u'2015-10-04T23:37:54Z',
+            'target_name': u'Opinicon Natural History',
+            'target_objectType': u'blog',
+            'url': u'http://opinicon.wordpress.com/species-accounts/giant-swallowtail-grande-porte-queue/',
+            'verb': u'like'}
+
 ## Tests of Helper Functions
 def test_get_value_if_present_nested():
     assert cf.get_value_if_present_nested({'first': 1}, ['first']) == 1
     assert cf.get_value_if_present_nested({'first': {'second': 1}}, ['first', 'second']) == 1
     assert cf.get_value_if_present_nested({'first': {'second': 1}}, ['first', 'third']) is None
 
+def test_compile_key_path():
+    examples = [{'first': {'second': {'third': 1}}}, {'first': [1]}, {'first': None}, [], 'text']
+    for key_list in [['first'], ['first', 'second'], ['first', 'second', 'third']]:
+        get_value = cf.compile_key_path(key_list)
+        for example in examples:
+            assert get_value(example) == cf.get_value_if_present_nested(example, key_list)
+
 def test_permissive_json_load():
     assert cf.permissive_json_load("""{"test": 10}""") == {'test': 10}
     assert cf.permissive_json_load("""Not really json""") == {}
+
+def test_until_stopped():
+    assert list(cf.until_stopped(iter([1, 2, 3]))) == [1, 2, 3]
+    cf.STOP_EVENT.set()
+    try:
+        assert list(cf.until_stopped(iter([1, 2, 3]))) == [1]
+        quiet_stream = iter([{'timeout': True}] * 3) # what a quiet Twitter stream yields
+        assert list(cf.until_stopped(quiet_stream)) == [{'timeout': True}]
+        assert not cf.is_tweet({'timeout': True})
+    finally:
+        cf.STOP_EVENT.clear()
+
+def test_print_twitter_stall_warning(monkeypatch):
+    logged = []
+    monkeypatch.setattr(cf, 'write_to_log', lambda stream_key, what_to_write: logged.append(what_to_write))
+    warning = {'warning': {
+        'code': 'FALLING_BEHIND', 
+        'message': 'Your connection is falling behind.', 
+        'percent_full': 60}}
+    assert cf.print_twitter_stall_warning('tweets', warning) is warning
+    assert cf.print_twitter_stall_warning('tweets', {'id': 1}) == {'id': 1}
+    assert len(logged) == 1
+    assert logged[0].endswith(
+        " stall warning FALLING_BEHIND: Your connection is falling behind. (60% full)\n")
+
+def test_read_into_queue():
+    line_queue = cf.Queue.Queue(maxsize=2)
+    stats = {'max_queue_depth': 0, 'dropped_lines': 0}
+    finished_reading = threading.Event()
+    def lines():
+        for line in ['a', 'b', 'c', 'd']:
+            yield line
+        finished_reading.set()
+    threading.Thread(target=cf.read_into_queue, args=(lines, line_queue, stats)).start()
+    finished_reading.wait(5)
+    assert list(cf.iterate_queue('test', line_queue, stats)) == ['a', 'b']
+    assert stats == {'max_queue_depth': 2, 'dropped_lines': 2}
+
+def test_iterate_queue_stops_when_quiet():
+    cf.STOP_EVENT.set()
+    try:
+        assert list(cf.iterate_queue('test', cf.Queue.Queue(), {})) == [] # returns, rather than waiting
+    finally:
+        cf.STOP_EVENT.clear()
+
+def test_backoff_delay():
+    assert 0.5 <= cf.backoff_delay(0, 1, 300) <= 1
+    assert 4 <= cf.backoff_delay(3, 1, 300) <= 8
+    assert 150 <= cf.backoff_delay(20, 1, 300) <= 300
+
+def test_reconnecting_stream_skips_markers(monkeypatch):
+    monkeypatch.setattr(cf, 'write_to_log', lambda stream_key, what_to_write: None)
+    gaps = []
+    monkeypatch.setattr(cf, 'record_gap', 
+        lambda stream_key, gap_start, gap_end, events_per_second: gaps.append(events_per_second))
+    monkeypatch.setattr(cf, 'backoff_delay', lambda attempt, initial_delay, max_delay: attempt)
+    connections = iter([
+        [{'id': 1}, {'id': 2}],
+        [{'timeout': True}, {'hangup': True}], # a stalled connection
+        ['\r\n', {'id': 3}]])
+    delays = []
+    def wait(delay):
+        delays.append(delay)
+        if len(delays) == 3:
+            cf.STOP_EVENT.set()
+    monkeypatch.setattr(cf.STOP_EVENT, 'wait', wait)
+    try:
+        items = list(cf.reconnecting_stream('test', lambda: iter(next(connections))))
+    finally:
+        cf.STOP_EVENT.clear()
+    assert len(items) == 6
+    assert delays == [0, 1, 0] # the markers didn't reset the backoff
+    assert len(gaps) == 2 # the gap lasted until {'id': 3}, then one until it was stopped
+    assert cf.is_stream_marker({'timeout': True}) and cf.is_stream_marker(' \r')
+    assert not cf.is_stream_marker({'id': 1}) and not cf.is_stream_marker('{}')
+
+def test_get_json_decoder():
+    assert cf.get_json_decoder('json') is json.loads
+    assert cf.get_json_decoder('not_a_json_library') is json.loads
+    assert cf.get_json_decoder('auto')("""{"test": 10}""") == {'test': 10}
+
+def test_is_keep_alive():
+    assert cf.is_keep_alive('')
+    assert cf.is_keep_alive(' \r')
+    assert not cf.is_keep_alive('{}')
+
+def test_should_rotate():
+    segment = {'rows': 10, 'opened_at': cf.time.time(), 'raw_file': None}
+    assert not cf.should_rotate(segment, {'max_rows': 0, 'max_bytes': 0, 'interval': 0})
+    assert not cf.should_rotate(segment, {'max_rows': 11, 'max_bytes': 0, 'interval': 3600 * 24 * 365})
+    assert cf.should_rotate(segment, {'max_rows': 10, 'max_bytes': 0, 'interval': 0})
+    segment['opened_at'] -= 3600
+    assert cf.should_rotate(segment, {'max_rows': 0, 'max_bytes': 0, 'interval': 3600})
+
+def test_batch_stream():
+    batching = {'max_rows': 3, 'max_bytes': 10**6, 'max_latency': 60}
+    rows = [{'id': 'a'}] * 7
+    batches = list(cf.batch_stream(iter(rows), batching))
+    assert [len(batch) for batch, _ in batches] == [3, 3, 1]
+    assert [batch_bytes for _, batch_bytes in batches] == [3, 3, 1]
+    batching['max_bytes'] = 2
+    assert [len(batch) for batch, _ in cf.batch_stream(iter(rows), batching)] == [2, 2, 2, 1]
+
+def test_batch_stream_interrupted():
+    def rows():
+        yield {'id': 'a'}
+        raise KeyboardInterrupt()
+    batching = {'max_rows': 3, 'max_bytes': 10**6, 'max_latency': 60}
+    try:
+        assert [len(batch) for batch, _ in cf.batch_stream(rows(), batching)] == [1]
+        assert cf.STOP_EVENT.is_set() # so a writer set to block stops retrying
+    finally:
+        cf.STOP_EVENT.clear()
+
+def test_save_in_batches(monkeypatch):
+    monkeypatch.setattr(cf, 'write_to_log', lambda stream_key, what_to_write: None)
+    saved = []
+    cf.save_in_batches('test', iter([{'id': str(x)} for x in range(2500)]), saved.append)
+    assert [row['id'] for row in cf.tz.concat(saved)] == [str(x) for x in range(2500)]
+
+def test_save_csv_gz_retry(monkeypatch, tmpdir):
+    monkeypatch.setattr(cf, 'write_to_log', lambda stream_key, what_to_write: None)
+    monkeypatch.setattr(cf, 'get_save_location',
+        lambda stream_key, file_ending: str(tmpdir.join(stream_key + file_ending)))
+    monkeypatch.setitem(cf.CONFIG, 'batching', dict(cf.CONFIG['batching'], max_rows=2))
+    monkeypatch.setitem(cf.CONFIG, 'csv_gz_rotation', {'max_rows': 0, 'max_bytes': 0, 'interval': 0})
+    monkeypatch.setitem(cf.CONFIG, 'csv_gz_fsync', True)
+    fsync_calls = []
+    def fsync_failing_once(fileno):
+        fsync_calls.append(fileno)
+        if len(fsync_calls) == 2: # the first batch, after its member was written
+            raise OSError("fsync failed")
+    monkeypatch.setattr(cf.os, 'fsync', fsync_failing_once)
+    cf.save_csv_gz('comments', iter([{'id': str(x)} for x in range(5)]))
+    file_name, = tmpdir.listdir(lambda x: x.basename.endswith(".csv.gz"))
+    saved = list(cf.csv.DictReader(cf.gzip.open(str(file_name))))
+    assert [row['id'] for row in saved] == [str(x) for x in range(5)]
+    manifest = list(cf.csv.DictReader(tmpdir.join("comments_manifest.csv").open('rb')))
+    assert manifest[0]['rows'] == '5'
+
+def test_write_row_groups_retry(monkeypatch, tmpdir):
+    if cf.pa is None:
+        return # saving to parquet needs pyarrow
+    monkeypatch.setattr(cf, 'get_save_location',
+        lambda stream_key, file_ending: str(tmpdir.join(stream_key + file_ending)))
+    failures = ['date=2015-10-13/hour=10'] # the second partition fails once
+    def open_failing_file(stream_key, schema, partition):
+        writer = open_parquet_file(stream_key, schema, partition)
+        class FailingWriter(object):
+            def write_table(self, table):
+                if partition in failures:
+                    failures.remove(partition)
+                    raise IOError("disk full")
+                writer.write_table(table)
+            def close(self):
+                writer.close()
+        return FailingWriter()
+    open_parquet_file = cf.open_parquet_file
+    monkeypatch.setattr(cf, 'open_parquet_file', open_failing_file)
+    field_plan = cf.STREAM_FIELDS['comments']
+    schema = cf.pa.schema([
+        cf.pa.field(column, cf.ARROW_TYPES[column_type]) for column, _, _, column_type in field_plan])
+    rows = [{'id': str(x), 'published': '2015-10-13T{:02d}:00:00Z'.format(9 + x % 2)} for x in range(6)]
+    parquet_files = {}
+    written = {'batch': None, 'partitions': set()}
+    try:
+        cf.write_row_groups('comments', schema, field_plan, parquet_files, written, rows)
+        assert False, "the write should have failed"
+    except IOError:
+        pass
+    cf.write_row_groups('comments', schema, field_plan, parquet_files, written, rows) # the retry
+    for writer in parquet_files.values():
+        writer.close()
+    num_rows = lambda hour: sum(
+        cf.pq.read_table(str(x)).num_rows 
+        for x in tmpdir.join('comments_parquet', 'date=2015-10-13', hour).listdir())
+    assert num_rows('hour=09') == 3 # rather than written again by the retry
+    assert num_rows('hour=10') == 3
+
+def test_add_topic():
+    topic_terms = [('debate', [u'debate', u'sanders']), ('weather', [u'rain'])]
+    add_topic = cf.add_topic(topic_terms, ['text', 'hashtags'])
+    assert add_topic({'text': u'The DEBATE tonight', 'hashtags': None})['topic'] == 'debate'
+    assert add_topic({'text': u'Rain', 'hashtags': u'Sanders'})['topic'] == 'debate, weather'
+    assert add_topic({'text': u'Nothing here', 'hashtags': u''})['topic'] is None
+
+def test_count_per_minute(monkeypatch, tmpdir):
+    monkeypatch.setitem(cf.CONFIG, 'per_minute_counts', {'folder': str(tmpdir), 'interval': 60})
+    rows = [
+        {'published': '2015-10-14T01:23:45Z', 'topic': 'debate'},
+        {'published': '2015-10-14T01:23:59Z', 'topic': None},
+        {'published': '2015-10-14T01:24:00Z', 'topic': 'debate, weather'}]
+    assert list(cf.count_per_minute('comments', iter(rows))) == rows
+    assert tmpdir.join('overall_count', 'count_comments.csv').read().splitlines() == [
+        'num_entries,minute,verb', '2,2015-10-14T01:23,comment', '1,2015-10-14T01:24,comment']
+    assert tmpdir.join('weather_count', 'count_comments.csv').read().splitlines() == [
+        'num_entries,minute,verb', '1,2015-10-14T01:24,comment']
+    list(cf.count_per_minute('comments', iter(rows[1:2]))) # restarted, adding to the counts
+    assert tmpdir.join('overall_count', 'count_comments.csv').read().splitlines()[1] == (
+        '3,2015-10-14T01:23,comment')
+
+def test_count_per_minute_save_error(monkeypatch, tmpdir):
+    monkeypatch.setattr(cf, 'write_to_log', lambda stream_key, what_to_write: None)
+    tmpdir.join('not_a_folder').write('')
+    monkeypatch.setitem(cf.CONFIG, 'per_minute_counts', {
+        'folder': str(tmpdir.join('not_a_folder')), 'interval': 60})
+    rows = [{'published': '2015-10-14T01:23:45Z', 'topic': None}]
+    assert list(cf.count_per_minute('comments', iter(rows))) == rows # carries on
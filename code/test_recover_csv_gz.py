@@ -0,0 +1,50 @@
+## These are some tests for recover_csv_gz.py
+## They can be run with pytest with the command `py.test test_recover_csv_gz.py`
+
+import recover_csv_gz as rcg
+import gzip
+import csv
+import cStringIO
+
+## Helper Functions
+def make_member(rows):
+    """Return the rows as a gzip member of CSV, as the consumers write each chunk"""
+    buffer = cStringIO.StringIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb") as member:
+        csv.writer(member).writerows(rows)
+    return buffer.getvalue()
+
+HEADER = ['id', 'text']
+ROWS = [[str(x), 'row "{}", with a comma'.format(x) * 20] for x in range(3000)]
+MEMBERS = [make_member([HEADER])] + [make_member(ROWS[x:x + 1000]) for x in range(0, 3000, 1000)]
+
+def recover(tmpdir, data):
+    """Recover the rows of the damaged data, returning the number of rows
+    saved and the rows read back from the recovered file"""
+    damaged_file = tmpdir.join("damaged.csv.gz")
+    damaged_file.write(data, 'wb')
+    recovered_file = str(tmpdir.join("recovered.csv.gz"))
+    num_rows = rcg.recover_csv_gz(str(damaged_file), recovered_file)
+    return num_rows, list(csv.reader(gzip.open(recovered_file)))
+
+## Tests of Recovering Functions
+def test_recover_complete_file(tmpdir):
+    assert recover(tmpdir, "".join(MEMBERS)) == (3001, [HEADER] + ROWS)
+
+def test_recover_at_member_boundary(tmpdir):
+    num_rows, rows = recover(tmpdir, "".join(MEMBERS[:3])) # the last chunk wasn't written
+    assert num_rows == 2001
+    assert rows == [HEADER] + ROWS[:2000]
+
+def test_recover_inside_member(tmpdir):
+    data = "".join(MEMBERS[:3]) + MEMBERS[3][:len(MEMBERS[3]) // 2] # cut off in the last chunk
+    num_rows, rows = recover(tmpdir, data)
+    assert num_rows == len(rows)
+    assert 2001 < num_rows < 3001 # the complete chunks, and the start of the damaged one
+    assert rows == [HEADER] + ROWS[:num_rows - 1] # with no partial or made up rows
+
+def test_recover_zeroed_tail(tmpdir):
+    data = "".join(MEMBERS[:3]) + MEMBERS[3][:len(MEMBERS[3]) // 2]
+    num_rows, rows = recover(tmpdir, data + '\0' * 5000) # as a file system may leave it
+    assert rows == [HEADER] + ROWS[:num_rows - 1]
+    assert num_rows > 2001
@@ -1,25 +1,28 @@
 -- To run this from the command line:
 -- sqlite3 example.sqlite < count.sql
+--
+-- The <table>_per_minute tables are kept up to date by load_to_db.py as
+-- rows are loaded, so these don't have to scan the tables themselves.
 
 .headers on
 .mode csv
 
 .output count_comments.csv
-select count(rowid) as num_entries, substr(published,0,17) as minute, 'comment' as verb
-from comments
-group by substr(published,0,17);
+select num_entries, minute, 'comment' as verb
+from comments_per_minute
+order by minute;
 
 .output count_likes.csv
-select count(rowid) as num_entries, substr(published,0,17) as minute, 'like' as verb
-from likes
-group by substr(published,0,17);
+select num_entries, minute, 'like' as verb
+from likes_per_minute
+order by minute;
 
 .output count_posts.csv
-select count(rowid) as num_entries, substr(published,0,17) as minute, 'post' as verb
-from posts
-group by substr(published,0,17);
+select num_entries, minute, 'post' as verb
+from posts_per_minute
+order by minute;
 
 .output count_tweets.csv
-select count(rowid) as num_entries, substr(created_at,0,17) as minute, 'tweet' as verb
-from tweets
-group by substr(created_at,0,17);
+select num_entries, minute, 'tweet' as verb
+from tweets_per_minute
+order by minute;